@@ -0,0 +1,56 @@
+"""Microbenchmark for email rendering: renders per second and payload bytes.
+
+Compares the precompiled, minified registry against the same templates loaded
+without minification. Run with `python bench_email_templates.py [iterations]`.
+"""
+import sys
+import time
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import Markup
+
+from email_templates import TEMPLATE_DIR, email_templates
+
+SAMPLES = {
+    "otp.html": {"otp": 482913},
+    "password_reset.html": {"reset_link": "https://lfreturnme.com/reset-password/6f1c9c1e-8d2f-4b8e-9d8c-1f0b5e2a7c11"},
+    "welcome.html": {"full_name": "Ada Obi"},
+    "lost_report.html": {"name": "Ada Obi", "description": "Black leather wallet"},
+    "found_thanks.html": {"name": "Musa Bello", "description": "Blue backpack"},
+    "item_lost.html": {"full_name": "Ada Obi", "item_description": "Silver laptop"},
+    "team_notice.html": {"text": "Item Laptop has been found at Abuja."},
+}
+
+
+def bench(render, iterations: int):
+    results = {}
+    for name, context in SAMPLES.items():
+        html = render(name, context)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            render(name, context)
+        elapsed = time.perf_counter() - start
+        results[name] = (iterations / elapsed, len(html.encode("utf-8")))
+    return results
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    email_templates.load()
+    registry = bench(lambda name, context: email_templates.render(name, year=2024, **context), iterations)
+
+    plain_env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(["html"]))
+    social_footer = plain_env.get_template("_social.html").render(year=2024)
+    plain = bench(lambda name, context: plain_env.get_template(name).render(
+        year=2024, social_footer=Markup(social_footer), **context), iterations)
+
+    print(f"{'template':<22}{'renders/s':>12}{'bytes':>8}{'unminified r/s':>16}{'bytes':>8}")
+    for name in SAMPLES:
+        rate, size = registry[name]
+        plain_rate, plain_size = plain[name]
+        print(f"{name:<22}{rate:>12,.0f}{size:>8}{plain_rate:>16,.0f}{plain_size:>8}")
+
+
+if __name__ == "__main__":
+    main()
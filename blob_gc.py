@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import crud
+from crud import blobs_collection, db, found_collection, items_collection, lost_collection, users_collection
+from jobs import PeriodicLeasedTask
+
+logger = logging.getLogger(__name__)
+
+blob_gc_collection = db["blob_gc"]
+
+# Queued blobs wait this long before deletion, so a record that picks the same
+# content up again in the meantime keeps it
+BLOB_GC_GRACE = timedelta(seconds=int(os.getenv("BLOB_GC_GRACE_SECONDS", 3600)))
+BLOB_GC_BATCH_SIZE = int(os.getenv("BLOB_GC_BATCH_SIZE", 100))
+BLOB_GC_INTERVAL = float(os.getenv("BLOB_GC_INTERVAL_SECONDS", 300))
+
+# Fields that can hold an uploaded file's URL
+REFERENCES = [
+    (users_collection, "profile_picture"),
+    (items_collection, "item_image"),
+    (lost_collection, "item_image"),
+    (found_collection, "item_image"),
+]
+
+
+async def ensure_indexes():
+    await blob_gc_collection.create_index("due_at")
+    # Serve the sweeper's "is this still referenced" checks
+    for collection, field in REFERENCES:
+        await collection.create_index(field)
+
+
+async def schedule_deletion(urls: List[str], key: Optional[str] = None, delay: timedelta = BLOB_GC_GRACE):
+    # urls[0] is the URL records store; the rest are its variants. key is the
+    # content hash record it belonged to, if any.
+    names = [name for name in map(crud.blob_name_from_url, urls) if name]
+    if not names:
+        logger.warning("Not deleting %s: not a URL in this bucket", urls[0])
+        return
+    now = datetime.utcnow()
+    await blob_gc_collection.update_one(
+        {"_id": urls[0]},
+        {"$set": {"names": names, "key": key, "due_at": now + delay},
+         "$setOnInsert": {"created_at": now}},
+        upsert=True
+    )
+
+
+class BlobSweeper(PeriodicLeasedTask):
+    # Deletes queued blobs in batches from a background task, after checking that
+    # no user, item or report points at them any more. Runs under a lease so only
+    # one worker sweeps at a time; entries stay queued until a sweep handles them.
+
+    def __init__(self, batch_size: int, interval: float):
+        super().__init__("blob_gc", interval, self.sweep)
+        self.batch_size = batch_size
+
+    async def _referenced(self, entries: List[dict]) -> set:
+        urls = [entry["_id"] for entry in entries]
+        keys = [entry["key"] for entry in entries if entry.get("key")]
+        found = await asyncio.gather(
+            *(collection.distinct(field, {field: {"$in": urls}}) for collection, field in REFERENCES),
+            blobs_collection.distinct("url", {"url": {"$in": urls}}),
+            blobs_collection.distinct("_id", {"_id": {"$in": keys}}),
+        )
+        live_keys = set(found[-1])
+        referenced = {url for values in found[:-1] for url in values}
+        referenced.update(entry["_id"] for entry in entries if entry.get("key") in live_keys)
+        return referenced
+
+    async def sweep_batch(self) -> int:
+        entries = await blob_gc_collection.find({"due_at": {"$lte": datetime.utcnow()}}) \
+            .sort("due_at", 1).limit(self.batch_size).to_list(length=self.batch_size)
+        if not entries:
+            return 0
+
+        referenced = await self._referenced(entries)
+        names = [name for entry in entries if entry["_id"] not in referenced for name in entry["names"]]
+        if names:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, crud.delete_blobs, names)
+
+        # Referenced entries are dropped too; they are queued again when released
+        await blob_gc_collection.delete_many({"_id": {"$in": [entry["_id"] for entry in entries]}})
+        logger.info("Deleted %d blobs, kept %d still in use", len(names), len(referenced))
+        return len(entries)
+
+    async def sweep(self) -> int:
+        total = 0
+        while True:
+            count = await self.sweep_batch()
+            total += count
+            if count < self.batch_size:
+                return total
+
+
+blob_sweeper = BlobSweeper(BLOB_GC_BATCH_SIZE, BLOB_GC_INTERVAL)
@@ -1,31 +1,35 @@
+import asyncio
 import base64
 import json
+import math
 import re
 import random
 import httpx
 import motor.motor_asyncio
-import requests
-from fastapi import UploadFile, HTTPException, BackgroundTasks
+from fastapi import HTTPException, BackgroundTasks
 import schemas
 import uuid
-import bcrypt
 import logging
-from schemas import Tag, ItemRegistration
+from schemas import ItemRegistration
 from bson import ObjectId
 import firebase_admin
 from firebase_admin import credentials, storage
-from typing import Optional
-from datetime import datetime, timedelta
+from typing import List, Optional
+from datetime import datetime, timedelta, timezone
 from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from google.api_core.exceptions import NotFound
 from dotenv import load_dotenv
 import hmac
 import hashlib
 from dateutil import parser
+from cachetools import TTLCache
 from pymongo import UpdateOne
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import smtplib
 import os
+import time
+from hashing import password_hasher
+from mailer import email_transport, smtp_mailer
+from email_templates import email_templates
 
 load_dotenv()
 
@@ -43,6 +47,9 @@ otp_collection = db["otp_collection"]
 access_collection = db['access']
 lost_collection = db["lost"]
 found_collection = db["found"]
+migrations_collection = db["migrations"]
+# One document per stored upload, keyed by content hash (see uploads.py)
+blobs_collection = db["blobs"]
 
 
 firebase_key_base64 = os.getenv("FIREBASE_KEY_BASE64")
@@ -61,12 +68,81 @@ MAILERLITE_API_KEY = os.getenv('MAILERLITE_API_KEY')
 MAILERLITE_SENDER_EMAIL = os.getenv('MAILERLITE_SENDER_EMAIL')
 brevo_api = os.getenv("BREVO_API")
 
+# Access codes stay valid for 15 minutes; each worker keeps the codes it has seen
+ACCESS_CODE_TTL = timedelta(minutes=15)
+access_code_cache = TTLCache(maxsize=10000, ttl=ACCESS_CODE_TTL.total_seconds())
+
+
+async def ensure_indexes():
+    # Called once at startup; create_index is a no-op when the index already exists
+    await _ensure_unique_index(users_collection, "email_address")
+    await users_collection.create_index("uuid")
+    await _ensure_unique_index(access_collection, "uuid")
+    await access_collection.create_index("timestamp", expireAfterSeconds=int(ACCESS_CODE_TTL.total_seconds()))
+    await items_collection.create_index([("subscription_status", 1), ("expires_at", 1)])
+    await items_collection.create_index("tag_id")
+    await _ensure_unique_tag_index()
+    await _ensure_unique_index(newsletters_collection, "email")
+    # Serves /items/ pages as range scans: equality on location, then the sort order
+    await found_collection.create_index([("location", 1), ("date", -1), ("_id", -1)])
+    await newsletters_collection.create_index("created_at", partialFilterExpression={"synced": False})
+
+
+async def _duplicate_values(collection, field: str, limit: int = 10) -> list:
+    pipeline = [
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": limit},
+    ]
+    return [doc["_id"] async for doc in collection.aggregate(pipeline, allowDiskUse=True)]
+
+
+async def _ensure_unique_index(collection, field: str) -> bool:
+    # Data written by the old check-then-insert code may repeat a value, and building
+    # the index over it would fail startup. Those values are reported instead and the
+    # index is created on the first start after they are cleaned up.
+    indexes = await collection.index_information()
+    if any(index["key"] == [(field, 1)] and index.get("unique") for index in indexes.values()):
+        return True
+    duplicates = await _duplicate_values(collection, field)
+    if duplicates:
+        logger.error("Not creating unique index on %s.%s, these values repeat: %s",
+                     collection.name, field, duplicates)
+        return False
+    await collection.create_index(field, unique=True)
+    return True
+
+
+async def _ensure_unique_tag_index():
+    # Databases set up before imports relied on it carry a plain tag1 index under the
+    # same name. It is swapped for a unique one only once no code repeats, and put
+    # back if the unique build fails, so lookups keep an index either way.
+    plain = (await tags_collection.index_information()).get("tag1_1")
+    if plain is None or plain.get("unique"):
+        await _ensure_unique_index(tags_collection, "tag1")
+        return
+
+    duplicates = await _duplicate_values(tags_collection, "tag1")
+    if duplicates:
+        logger.error("Keeping non-unique index on tags.tag1, these codes repeat: %s", duplicates)
+        return
+    logger.info("Replacing non-unique tags.tag1 index with a unique one")
+    await tags_collection.drop_index("tag1_1")
+    try:
+        await tags_collection.create_index("tag1", unique=True)
+    except OperationFailure as e:
+        # A repeat inserted since the check
+        logger.error("Unique index on tags.tag1 failed, restoring the plain one: %s", e)
+        await tags_collection.create_index("tag1")
+
 
 async def check_credentials(email_address: str) -> bool:
+    # Cheap pre-check served from the unique email index; the insert in
+    # create_user stays the source of truth for races
     try:
-        count = await users_collection.count_documents({"email_address": email_address})
-        logger.debug("check_credentials: email_address=%s, count=%d", email_address, count)
-        return count == 0
+        existing = await users_collection.find_one({"email_address": email_address}, {"_id": 1})
+        logger.debug("check_credentials: email_address=%s, exists=%s", email_address, existing is not None)
+        return existing is None
     except Exception as e:
         logger.error("Error in check_credentials: %s", e)
         raise
@@ -75,31 +151,32 @@ async def check_credentials(email_address: str) -> bool:
 async def create_user(user: schemas.Signup) -> schemas.ResponseSignup:
     try:
         user_uuid = str(uuid.uuid4())
-        hashed_password = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt())
-
-        if await check_credentials(user.email_address):
-            user_data = {
-                "uuid": user_uuid,
-                "full_name": user.full_name,
-                "email_address": user.email_address,
-                "date_of_birth": user.date_of_birth.isoformat(),
-                "address": user.address,
-                #"id_no": user.id_no,
-                "profile_picture": user.profile_picture,
-                "phone_number": user.phone_number,
-                "gender": user.gender,
-                #"valid_id_type": user.valid_id_type,
-                #"id_card_image": user.id_card_image,
-                "password": hashed_password.decode('utf-8'),
-                "is_verified": user.is_verified
+        hashed_password = await password_hasher.hash(user.password)
+
+        user_data = {
+            "uuid": user_uuid,
+            "full_name": user.full_name,
+            "email_address": user.email_address,
+            "date_of_birth": user.date_of_birth.isoformat(),
+            "address": user.address,
+            #"id_no": user.id_no,
+            "profile_picture": user.profile_picture,
+            "profile_picture_variants": user.profile_picture_variants,
+            "phone_number": user.phone_number,
+            "gender": user.gender,
+            #"valid_id_type": user.valid_id_type,
+            #"id_card_image": user.id_card_image,
+            "password": hashed_password,
+            "is_verified": user.is_verified
 
-            }
+        }
+        try:
             await users_collection.insert_one(user_data)
-            logger.info("User created successfully: %s", user_uuid)
-            return schemas.ResponseSignup(**user_data)
-        else:
+        except DuplicateKeyError:
             logger.warning("create_user: Email address already exists: %s", user.email_address)
             return None
+        logger.info("User created successfully: %s", user_uuid)
+        return schemas.ResponseSignup(**with_served_image(user_data, "profile_picture"))
     except Exception as e:
         logger.error("Error in create_user: %s", e)
         raise
@@ -112,11 +189,12 @@ async def authenticate_user(email_address: str, password: str) -> schemas.Respon
             logger.warning("User does not exist: %s", email_address)
             raise HTTPException(status_code=404, detail="User does not exist")
 
-        if bcrypt.checkpw(password.encode('utf-8'), user['password'].encode('utf-8')):
+        if await password_hasher.verify(password, user['password']):
             logger.info("User authenticated successfully: %s", email_address)
 
             # Generate access token using save_access_token function
             access_token = await save_access_code(user.get("uuid"))  # Assuming this function generates a token
+            user = with_served_image(user, "profile_picture")
 
             # Update user with access_token and return updated schema
             return schemas.ResponseSignup(
@@ -127,6 +205,7 @@ async def authenticate_user(email_address: str, password: str) -> schemas.Respon
                 address=user.get("address"),
                 id_no=user.get("id_no"),
                 profile_picture=user.get("profile_picture"),
+                profile_picture_variants=user.get("profile_picture_variants"),
                 phone_number=user.get("phone_number"),
                 gender=user.get("gender"),
                 valid_id_type=user.get("valid_id_type"),
@@ -134,7 +213,7 @@ async def authenticate_user(email_address: str, password: str) -> schemas.Respon
                 password=user.get("password"),
                 is_verified=user.get("is_verified"),
                 access_token=access_token,  # Adding the generated access_token here
-                items=user.get("items", {})  # Default to empty dict if items not present
+                items=with_served_images(with_subscription_states(user.get("items", {})))  # Default to empty dict if items not present
             )
         else:
             logger.warning("Invalid password for user: %s", email_address)
@@ -146,69 +225,194 @@ async def authenticate_user(email_address: str, password: str) -> schemas.Respon
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
-async def get_tag_by_tag1(tag1: str) -> Optional[Tag]:
-    tag_data = await tags_collection.find_one({"tag1": tag1})
-    print(tag_data)
-    if tag_data:
-        return Tag(**tag_data)
-
-    return None
+async def claim_tag(tag1: str, uuid: str) -> Optional[dict]:
+    # One round trip that only succeeds for an existing, unowned tag, so concurrent
+    # registrations can't both win. Returns the tag as it was before the claim.
+    return await tags_collection.find_one_and_update(
+        {"tag1": tag1, "is_owned": False},
+        {"$set": {"is_owned": True, "uuid": uuid}},
+        projection={"uuid": 1},
+        return_document=ReturnDocument.BEFORE
+    )
 
 
-async def update_tag(tag1: str, uuid: str) -> bool:
+async def release_tag(tag1: str, uuid: str, previous_uuid: Optional[str]) -> bool:
+    # Undoes claim_tag when the registration fails after claiming
     result = await tags_collection.update_one(
-        {"tag1": tag1},
-        {"$set": {"is_owned": True, "uuid": uuid}}
+        {"tag1": tag1, "is_owned": True, "uuid": uuid},
+        {"$set": {"is_owned": False, "uuid": previous_uuid or ""}}
     )
     return result.modified_count > 0
 
 
+async def remove_item_registration(tag_id: str, uuid: str):
+    await asyncio.gather(
+        items_collection.delete_one({"tag_id": tag_id, "uuid": uuid}),
+        users_collection.update_one({"uuid": uuid}, {"$unset": {_user_item_path(tag_id): ""}}),
+    )
+
+
 async def save_item_registration(item: ItemRegistration) -> bool:
     item_dict = item.dict()
     result = await items_collection.insert_one(item_dict)
     return result.inserted_id is not None
 
 
-async def update_user_items(uuid: str, item: ItemRegistration) -> bool:
-    user = await users_collection.find_one({"uuid": uuid})
-    if user:
-        items = user.get("items", {})
-        items[item.tag_id] = item.dict()  # Use tag_id as the key and the item dict as the value
-        result = await users_collection.update_one(
-            {"uuid": uuid},
-            {"$set": {"items": items}}
-        )
-        return result.modified_count > 0
-    return False
+def is_valid_tag_id(tag_id: str) -> bool:
+    # users.items is keyed by tag_id, so it must be usable as a field name
+    tag_id = str(tag_id)
+    return bool(tag_id) and "." not in tag_id and not tag_id.startswith("$")
 
 
-def upload_to_firebase(file: UploadFile, folder_name: str) -> str:
-    bucket = storage.bucket()
+def _user_item_path(tag_id: str, field: Optional[str] = None) -> str:
+    # The key becomes part of a dotted update path; routes reject bad IDs with a 400
+    # before getting here
+    tag_id = str(tag_id)
+    if not is_valid_tag_id(tag_id):
+        raise ValueError(f"Invalid tag_id for item path: {tag_id!r}")
+    return f"items.{tag_id}.{field}" if field else f"items.{tag_id}"
+
+
+async def set_user_item(uuid: str, tag_id: str, item: dict):
+    # Writes one entry of users.items without reading or rewriting the others
+    return await users_collection.update_one(
+        {"uuid": uuid},
+        {"$set": {_user_item_path(tag_id): item}}
+    )
 
-    # Generate the file path by prepending the folder name to the file name
-    blob = bucket.blob(f"{folder_name}/{uuid.uuid4()}-{file.filename}")
 
-    # Upload the file to the specified folder in Firebase
-    blob.upload_from_string(file.file.read(), content_type=file.content_type)
+async def set_user_item_fields(uuid: str, tag_id: str, fields: dict):
+    # Only touches fields of an item the user already has
+    return await users_collection.update_one(
+        {"uuid": uuid, _user_item_path(tag_id): {"$exists": True}},
+        {"$set": {_user_item_path(tag_id, field): value for field, value in fields.items()}}
+    )
 
-    # Make the file publicly accessible
-    blob.make_public()
 
-    # Return the public URL of the uploaded file
+async def update_user_items(uuid: str, item: ItemRegistration) -> bool:
+    # Use tag_id as the key and the item dict as the value
+    result = await set_user_item(uuid, item.tag_id, item.dict())
+    return result.matched_count > 0
+
+
+# Must be a multiple of 256KB; also the most any one upload holds in memory
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+# Object names never get new content (they are derived from a hash or a fresh uuid),
+# so browsers and CDNs may keep them for a year without revalidating
+BLOB_CACHE_CONTROL = os.getenv("BLOB_CACHE_CONTROL", "public, max-age=31536000, immutable")
+# How image URLs reach clients:
+#   "public": the bucket grants allUsers Storage Object Viewer at bucket level, so the
+#             stored public URL is served as is and objects need no per-object ACL
+#   "signed": the bucket stays private and responses carry signed URLs, cached so a
+#             client keeps seeing (and caching) the same URL
+STORAGE_URL_MODE = os.getenv("STORAGE_URL_MODE", "public")
+# V4 signed URLs are valid for 7 days at most; reissue them halfway through
+SIGNED_URL_TTL = timedelta(days=7)
+signed_url_cache = TTLCache(maxsize=50000, ttl=SIGNED_URL_TTL.total_seconds() / 2)
+
+
+def upload_blob(blob_name: str, stream, content_type: Optional[str], size: int) -> str:
+    # Blocking; run it through uploads.upload_service rather than on the event loop
+    bucket = storage.bucket()
+    blob = bucket.blob(blob_name, chunk_size=UPLOAD_CHUNK_SIZE)
+    # Sent with the upload itself, no separate metadata call
+    blob.cache_control = BLOB_CACHE_CONTROL
+
+    # Small files go up in a single request. Anything bigger than a chunk is sent as a
+    # resumable upload straight from the stream, one chunk at a time (a known size
+    # would make the client buffer files up to 8MB for a multipart upload).
+    stream.seek(0)
+    blob.upload_from_file(stream, content_type=content_type,
+                          size=size if size <= UPLOAD_CHUNK_SIZE else None)
+
+    # The stored URL; see STORAGE_URL_MODE for how it is served
     return blob.public_url
 
 
-from urllib.parse import unquote
+def signed_upload_url(blob_name: str, headers: dict, expiration: timedelta) -> str:
+    # V4 signed PUT; the client has to send exactly these headers. With
+    # STORAGE_EMULATOR_HOST set (e.g. fake-gcs-server) the URL points at the emulator.
+    blob = storage.bucket().blob(blob_name)
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=expiration,
+        method="PUT",
+        content_type=headers["Content-Type"],
+        headers={name: value for name, value in headers.items() if name != "Content-Type"},
+        api_access_endpoint=os.getenv("STORAGE_EMULATOR_HOST") or "https://storage.googleapis.com",
+    )
+
+
+def get_uploaded_blob(blob_name: str):
+    # Metadata only; None if the client never completed the upload
+    return storage.bucket().get_blob(blob_name)
+
+
+def blob_public_url(blob_name: str) -> str:
+    return storage.bucket().blob(blob_name).public_url
+
 
+def serve_url(url: Optional[str]) -> Optional[str]:
+    # Stored URLs stay canonical (reference counts and GC match on them); in signed
+    # mode they are swapped for a signed GET URL on the way out. Signing is local.
+    if STORAGE_URL_MODE != "signed" or not url:
+        return url
+    signed = signed_url_cache.get(url)
+    if signed is None:
+        blob_name = blob_name_from_url(url)
+        if blob_name is None:
+            return url
+        signed = storage.bucket().blob(blob_name).generate_signed_url(
+            version="v4", expiration=SIGNED_URL_TTL, method="GET")
+        signed_url_cache[url] = signed
+    return signed
 
-def delete_from_firebase(url: str) -> None:
+
+def with_served_image(doc: dict, field: str) -> dict:
+    if STORAGE_URL_MODE != "signed":
+        return doc
+    doc = dict(doc)
+    doc[field] = serve_url(doc.get(field))
+    if doc.get(f"{field}_variants"):
+        doc[f"{field}_variants"] = {name: serve_url(url) for name, url in doc[f"{field}_variants"].items()}
+    return doc
+
+
+def with_served_images(items: dict) -> dict:
+    return {tag_id: with_served_image(item, "item_image") for tag_id, item in items.items()}
+
+
+from urllib.parse import unquote, urlparse
+
+# Cloud Storage accepts at most 100 calls per batch request
+DELETE_BATCH_SIZE = 100
+
+
+def blob_name_from_url(url: str) -> Optional[str]:
+    # Handles both the storage.googleapis.com/<bucket>/<name> public URLs and
+    # firebasestorage.googleapis.com/v0/b/<bucket>/o/<name> download URLs
     bucket = storage.bucket()
-    # Extract the blob name from the URL
-    blob_name = url.split("lfreturnme-5a551.appspot.com/")[-1]
     # Decode percent-encoded characters
-    blob_name = unquote(blob_name)
-    blob = bucket.blob(blob_name)
-    blob.delete()
+    path = unquote(urlparse(url).path)
+    if path.startswith(f"/v0/b/{bucket.name}/o/"):
+        return path.split("/o/", 1)[1]
+    if path.startswith(f"/{bucket.name}/"):
+        return path[len(bucket.name) + 2:]
+    return None
+
+
+def delete_blobs(blob_names: List[str]) -> None:
+    # Blocking; one batch request per 100 deletes. Objects that are already gone are ignored.
+    bucket = storage.bucket()
+    for start in range(0, len(blob_names), DELETE_BATCH_SIZE):
+        names = blob_names[start:start + DELETE_BATCH_SIZE]
+        try:
+            with bucket.client.batch():
+                for name in names:
+                    bucket.blob(name).delete()
+        except NotFound:
+            # The batch reports the first failure; retry the rest one by one, skipping misses
+            bucket.delete_blobs(names, on_error=lambda blob: None)
 
 
 async def create_reset_token(email_address: str) -> str:
@@ -246,10 +450,10 @@ async def validate_reset_token(token: str) -> str:
 
 async def update_password(email_address: str, new_password: str) -> bool:
     try:
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = await password_hasher.hash(new_password)
         updated_user = await users_collection.find_one_and_update(
             {"email_address": email_address},
-            {"$set": {"password": hashed_password.decode('utf-8')}},
+            {"$set": {"password": hashed_password}},
             return_document=ReturnDocument.AFTER
         )
         return updated_user is not None
@@ -259,17 +463,50 @@ async def update_password(email_address: str, new_password: str) -> bool:
 
 
 async def add_newsletter_email(email: str) -> bool:
+    # Single upsert behind the unique index; Brevo is synced later by newsletter.NewsletterSync
     try:
-        existing_email = await newsletters_collection.find_one({"email": email})
-        if existing_email:
-            return False
-        await newsletters_collection.insert_one({"email": email})
-        return True
+        result = await newsletters_collection.update_one(
+            {"email": email},
+            {"$setOnInsert": {"email": email, "synced": False, "created_at": datetime.utcnow()}},
+            upsert=True
+        )
+        return result.upserted_id is not None
+    except DuplicateKeyError:
+        # A concurrent request inserted the same email first
+        return False
     except Exception as e:
         logger.error("Error in add_newsletter_email: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+def encode_items_cursor(item: dict) -> str:
+    # Opaque to clients: the (date, _id) of the last item on the page
+    payload = json.dumps([item["date"], str(item["_id"])], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_items_cursor(cursor: str) -> tuple:
+    try:
+        date, item_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(date), ObjectId(item_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def find_items_page(location: str, page_size: int, cursor: Optional[str] = None, skip: int = 0):
+    # Newest first, with _id breaking ties within a day so pages never overlap or
+    # skip items. With a cursor the query resumes right after the previous page
+    # instead of skipping over it.
+    query = {"location": location}
+    if cursor:
+        date, item_id = decode_items_cursor(cursor)
+        query["$or"] = [{"date": {"$lt": date}}, {"date": date, "_id": {"$lt": item_id}}]
+    items = await found_collection.find(query).sort([("date", -1), ("_id", -1)]) \
+        .skip(0 if cursor else skip).limit(page_size).to_list(length=page_size)
+    next_cursor = encode_items_cursor(items[-1]) if len(items) == page_size else None
+    return items, next_cursor
+
+
 async def add_to_lost(lostfound: schemas.LostFound):
     result = await db.lost.insert_one(lostfound.dict())
     return str(result.inserted_id)
@@ -291,54 +528,126 @@ async def update_item_status(tag_id: str):
     return result.modified_count > 0
 
 
+OWNER_PROJECTION = {"_id": 0, "uuid": 1, "full_name": 1, "email_address": 1}
+
+
+async def lookup_tags(tag_ids: List[str]) -> List[dict]:
+    # Two $in queries for the whole batch: the items on the tags, then their owners.
+    # Only what a finder's desk needs comes back; no owner details.
+    tag_ids = list(dict.fromkeys(tag_ids))
+    items = await items_collection.find(
+        {"tag_id": {"$in": tag_ids}},
+        {"_id": 0, "tag_id": 1, "item_name": 1, "item_type": 1, "status": 1, "uuid": 1,
+         "subscription_status": 1, "expires_at": 1}
+    ).to_list(length=None)
+    now = datetime.utcnow()
+    items = {item["tag_id"]: with_subscription_state(item, now) for item in items}
+
+    owner_uuids = list({item["uuid"] for item in items.values() if item.get("uuid")})
+    owners = await users_collection.find(
+        {"uuid": {"$in": owner_uuids}, "email_address": {"$nin": [None, ""]}}, {"_id": 0, "uuid": 1}
+    ).to_list(length=len(owner_uuids))
+    reachable = {owner["uuid"] for owner in owners}
+
+    results = []
+    for tag_id in tag_ids:
+        item = items.get(tag_id)
+        if item is None:
+            results.append({"tag_id": tag_id, "registered": False})
+            continue
+        results.append({
+            "tag_id": tag_id,
+            "registered": True,
+            "item_name": item.get("item_name"),
+            "item_type": item.get("item_type"),
+            "status": item.get("status"),
+            # The owner can be emailed and the item's subscription is still live
+            "notify_owner": item.get("uuid") in reachable
+                            and item.get("subscription_status") in LIVE_SUBSCRIPTION_STATUSES,
+        })
+    return results
+
+
+async def user_exists(uuid: str) -> bool:
+    return await users_collection.find_one({"uuid": uuid}, {"_id": 1}) is not None
+
+
 async def find_user_by_uuid(uuid: str):
     user = await db.users.find_one({"uuid": uuid})
     return user
 
 
-async def update_item_status_full(uuid: str, tagid: str, new_status: str, users_collection, items_collection):
-    try:
-        # Find user by UUID
-        user = await users_collection.find_one({"uuid": uuid})
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+async def set_item_status(tag_id: str, new_status: str, changed_at: datetime,
+                          uuid: Optional[str] = None) -> Optional[dict]:
+    # Conditional on ownership when the caller knows the uuid. Returns the item as it
+    # was before, so the caller can undo the write.
+    query = {"tag_id": tag_id}
+    if uuid:
+        query["uuid"] = uuid
+    return await items_collection.find_one_and_update(
+        query,
+        {"$set": {"status": new_status, "status_changed_at": changed_at}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
 
-        # Check if the item with the given tagid exists in the user's items
-        if tagid not in user.get("items", {}):
-            raise HTTPException(status_code=404, detail=f"Item with tag ID {tagid} not found for user")
 
-        # Update the item's status in the user's items
-        user["items"][tagid]["status"] = str(new_status)
+async def set_owner_item_status(uuid: str, tag_id: str, new_status: str) -> Optional[dict]:
+    # Mirrors the status onto the owner's copy and returns the owner's contact fields,
+    # plus the copy's previous status
+    return await users_collection.find_one_and_update(
+        {"uuid": uuid, _user_item_path(tag_id): {"$exists": True}},
+        {"$set": {_user_item_path(tag_id, "status"): new_status}},
+        projection={**OWNER_PROJECTION, _user_item_path(tag_id, "status"): 1},
+        return_document=ReturnDocument.BEFORE
+    )
 
-        # Update user document with the modified items dictionary
-        user_result = await users_collection.update_one(
-            {"uuid": uuid},
-            {"$set": {"items": user["items"]}}
-        )
 
-        #if user_result.modified_count == 0:
-        #   raise HTTPException(status_code=500, detail="Failed to update item status in user's items")
+async def _revert_item_status(tag_id: str, new_status: str, previous: dict):
+    await items_collection.update_one(
+        {"tag_id": tag_id, "uuid": previous.get("uuid"), "status": new_status},
+        {"$set": {"status": previous.get("status")}}
+    )
 
-        # Find item in the items collection by tagid
-        item = await items_collection.find_one({"tag_id": tagid})
-        if not item:
-            raise HTTPException(status_code=404, detail="Item not found in items collection")
 
-        # Update the item's status in the items collection
-        item_result = await items_collection.update_one(
-            {"tag_id": tagid},
-            {"$set": {"status": new_status}}
+async def _revert_owner_item_status(tag_id: str, new_status: str, owner: dict):
+    previous = owner.get("items", {}).get(tag_id, {}).get("status")
+    await users_collection.update_one(
+        {"uuid": owner["uuid"], _user_item_path(tag_id, "status"): new_status},
+        {"$set": {_user_item_path(tag_id, "status"): previous}}
+    )
+
+
+async def transition_item_status(tag_id: str, new_status: str, uuid: Optional[str] = None):
+    # The item and the owner's copy change together or not at all: if one write
+    # misses, the one that landed is put back before the 404. Also returns the
+    # item's previous status; item.status_changed_at identifies this transition.
+    new_status = str(new_status)
+    changed_at = datetime.utcnow()
+    if uuid:
+        # Both writes are conditional on the same owner, so they can run together
+        item, owner = await asyncio.gather(
+            set_item_status(tag_id, new_status, changed_at, uuid),
+            set_owner_item_status(uuid, tag_id, new_status)
         )
+    else:
+        item = await set_item_status(tag_id, new_status, changed_at)
+        owner = await set_owner_item_status(item["uuid"], tag_id, new_status) if item else None
 
-        #if item_result.modified_count == 0:
-        #    raise HTTPException(status_code=500, detail="Failed to update item status in items collection")
+    if item and not owner:
+        await _revert_item_status(tag_id, new_status, item)
+    if owner and not item:
+        await _revert_owner_item_status(tag_id, new_status, owner)
 
-        return {"message": "Item status updated successfully", "item_tagid": tagid, "new_status": new_status}
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if not owner:
+        raise HTTPException(status_code=404, detail=f"Item with tag ID {tag_id} not found for user")
 
-    except HTTPException as e:
-        raise e
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    previous_status = item.get("status")
+    item.update(status=new_status, status_changed_at=changed_at)
+    owner.pop("items", None)
+    return ItemRegistration(**item), owner, previous_status
 
 
 async def get_user_by_uuid(user_uuid: str):
@@ -397,8 +706,7 @@ def generate_otp():
 #         raise HTTPException(status_code=500, detail="Failed to send OTP email")
 
 
-def send_email_otp(email: str, otp: int):
-    url = "https://api.brevo.com/v3/smtp/email"
+async def send_email_otp(email: str, otp: int):
     payload = {
         "sender": {
             "name": "LFReturnMe Team",  # Sender name
@@ -410,236 +718,19 @@ def send_email_otp(email: str, otp: int):
             }
         ],
         "subject": "Your OTP Code",
-        "htmlContent": f"""
-        <html>
-        <head>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    background-color: #f4f4f4;
-                    margin: 0;
-                    padding: 0;
-                }}
-                .email-container {{
-                    max-width: 600px;
-                    margin: 20px auto;
-                    background-color: #ffffff;
-                    padding: 20px;
-                    border-radius: 8px;
-                    box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-                    text-align: center;
-                }}
-                .email-header {{
-                    padding: 20px;
-                    background-color: #000000;  /* Changed header color to black */
-                    color: white;
-                    border-radius: 8px 8px 0 0;
-                }}
-                .email-header img {{
-                    width: 120px;
-                }}
-                .email-body {{
-                    padding: 20px;
-                    color: #333333;
-                    line-height: 1.6;
-                }}
-                .otp {{
-                    font-size: 24px;
-                    font-weight: bold;
-                    color: #007BFF;
-                }}
-                .email-footer {{
-                    padding: 20px;
-                    color: #999999;
-                    font-size: 12px;
-                    border-top: 1px solid #e0e0e0;
-                }}
-                .social-icons {{
-                    margin: 10px 0;
-                }}
-                .social-icons a {{
-                    margin: 0 10px;
-                }}
-                .social-icons img {{
-                    width: 24px;
-                    vertical-align: middle;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="email-container">
-                <div class="email-header">
-                    <img src="https://res.cloudinary.com/dskwy11us/image/upload/v1727959923/logo2_4_1_usow6b.png" alt="LFReturnMe Logo">
-                    <h1>Welcome to LFReturnMe!</h1>
-                </div>
-                <div class="email-body">
-                    <h2>Your OTP Code</h2>
-                    <p>Your OTP is: <span class="otp">{otp}</span></p>
-                    <p>Please use this code to complete your verification.</p>
-                </div>
-                <div class="email-footer">
-                    <p>Best regards,<br><strong>LFReturnMe Team</strong></p>
-                    <p>Connect with us on social media:</p>
-                    <div class="social-icons">
-                        <a href="https://www.instagram.com/lfreturnme" target="_blank">
-                            <img src="https://cdn-icons-png.flaticon.com/512/2111/2111463.png" alt="Instagram">
-                        </a>
-                        <a href="https://twitter.com/LFReturnMe1" target="_blank">
-                            <img src="https://res.cloudinary.com/dskwy11us/image/upload/v1729692730/X_tobavt.png" alt="X">  <!-- Updated Twitter logo to X -->
-                        </a>
-                        <a href="https://www.linkedin.com/company/lfreturnme" target="_blank">
-                            <img src="https://cdn-icons-png.flaticon.com/512/174/174857.png" alt="LinkedIn">
-                        </a>
-                        <a href="https://www.facebook.com/LFReturnMe" target="_blank">
-                            <img src="https://cdn-icons-png.flaticon.com/512/733/733547.png" alt="Facebook">
-                        </a>
-                    </div>
-                    <p>&copy; {datetime.now().year} LFReturnMe. All rights reserved.</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-    }
-
-    headers = {
-        'accept': 'application/json',
-        'api-key': brevo_api,  # Replace with your Brevo API key
-        'Content-Type': 'application/json',
+        "htmlContent": email_templates.render("otp.html", otp=otp)
     }
 
     # Send the POST request
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()  # Raises an HTTPError if the status is 4xx or 5xx
-        return response.json()  # Return the response JSON
-    except requests.exceptions.RequestException as e:
-        # Handle request exceptions (timeout, connection error, etc.)
-        raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
-
-
-def send_email(to_email: str, subject: str, body_content: str):
-    url = "https://api.brevo.com/v3/smtp/email"
-    payload = {
-        "sender": {
-            "name": "LFReturnMe Team",  # Replace with your sender name
-            "email": "no_reply@lfreturnme.com"  # Replace with your sender email
-        },
-        "to": [
-            {
-                "email": to_email
-            }
-        ],
-        "subject": subject,
-        "htmlContent": f"""
-        <html>
-        <head>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    background-color: #f4f4f4;
-                    margin: 0;
-                    padding: 0;
-                    -webkit-font-smoothing: antialiased;
-                    -moz-osx-font-smoothing: grayscale;
-                }}
-                .email-container {{
-                    max-width: 600px;
-                    margin: 20px auto;
-                    background-color: #ffffff;
-                    padding: 20px;
-                    border-radius: 8px;
-                    box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-                }}
-                .email-header {{
-                    text-align: center;
-                    padding-bottom: 20px;
-                    border-bottom: 1px solid #e0e0e0;
-                }}
-                .email-header img {{
-                    width: 120px;
-                }}
-                .email-body {{
-                    padding: 20px;
-                    color: #333333;
-                    line-height: 1.6;
-                }}
-                .email-body h2 {{
-                    color: #333;
-                }}
-                .email-footer {{
-                    text-align: center;
-                    padding: 20px;
-                    color: #999999;
-                    border-top: 1px solid #e0e0e0;
-                }}
-                .social-icons {{
-                    margin: 10px 0;
-                }}
-                .social-icons img {{
-                    width: 24px;
-                    margin: 0 10px;
-                    vertical-align: middle;
-                }}
-                a {{
-                    color: #007BFF;
-                    text-decoration: none;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="email-container">
-                <div class="email-header">
-                    <img src="https://res.cloudinary.com/dskwy11us/image/upload/v1727959923/logo2_4_1_usow6b.png" alt="LFReturnMe Logo">
-                </div>
-                <div class="email-body">
-                    {body_content}
-                    <p>Best regards,<br><strong>LFReturnMe Team</strong></p>
-                </div>
-                <div class="email-footer">
-                    <p>Connect with us on social media:</p>
-                    <div class="social-icons">
-                        <a href="https://www.instagram.com/lfreturnme" target="_blank">
-                            <img src="https://cdn-icons-png.flaticon.com/512/2111/2111463.png" alt="Instagram">
-                        </a>
-                        <a href="https://twitter.com/LFReturnMe1" target="_blank">
-                            <img src="https://res.cloudinary.com/dskwy11us/image/upload/v1729692730/X_tobavt.png" alt="Twitter">
-                        </a>
-                        <a href="https://www.linkedin.com/company/lfreturnme" target="_blank">
-                            <img src="https://cdn-icons-png.flaticon.com/512/174/174857.png" alt="LinkedIn">
-                        </a>
-                        <a href="https://www.facebook.com/LFReturnMe" target="_blank">
-                            <img src="https://cdn-icons-png.flaticon.com/512/733/733547.png" alt="Facebook">
-                        </a>
-                    </div>
-                    <p>&copy; {datetime.now().year} LFReturnMe. All rights reserved.</p>
-                    <p>Website: <a href="https://www.lfreturnme.com">www.lfreturnme.com</a></p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-    }
-
-    headers = {
-        'accept': 'application/json',
-        'api-key': brevo_api,  # Replace with your Brevo API key
-        'Content-Type': 'application/json',
-    }
-
-    # Sending the email
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()  # Raises an HTTPError if the status is 4xx or 5xx
-        print("Email sent successfully!")
-    except requests.exceptions.RequestException as e:
+        return await email_transport.send(payload)  # Return the response JSON
+    except httpx.HTTPError as e:
         # Handle request exceptions (timeout, connection error, etc.)
         raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
 
 
 # Example usage
-def send_email_reset(to_email: str, reset_link: str):
-    url = "https://api.brevo.com/v3/smtp/email"
+async def send_email_reset(to_email: str, reset_link: str):
     payload = {
         "sender": {
             "name": "LFReturnMe Team",  # Sender name
@@ -651,110 +742,14 @@ def send_email_reset(to_email: str, reset_link: str):
             }
         ],
         "subject": "Password Reset Request",
-        "htmlContent": f"""
-        <html>
-        <head>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    background-color: #f4f4f4;
-                    margin: 0;
-                    padding: 0;
-                }}
-                .email-container {{
-                    max-width: 600px;
-                    margin: 20px auto;
-                    background-color: #ffffff;
-                    padding: 20px;
-                    border-radius: 8px;
-                    box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-                    text-align: center;
-                }}
-                .email-header {{
-                    padding: 20px;
-                    background-color: #000000;  /* Header color */
-                    color: white;
-                    border-radius: 8px 8px 0 0;
-                }}
-                .email-header img {{
-                    width: 120px;
-                }}
-                .email-body {{
-                    padding: 20px;
-                    color: #333333;
-                    line-height: 1.6;
-                }}
-                .reset-link {{
-                    font-size: 20px;
-                    font-weight: bold;
-                    color: #007BFF;
-                }}
-                .email-footer {{
-                    padding: 20px;
-                    color: #999999;
-                    font-size: 12px;
-                    border-top: 1px solid #e0e0e0;
-                }}
-                .social-icons {{
-                    margin: 10px 0;
-                }}
-                .social-icons a {{
-                    margin: 0 10px;
-                }}
-                .social-icons img {{
-                    width: 24px;
-                    vertical-align: middle;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="email-container">
-                <div class="email-header">
-                    <img src="https://res.cloudinary.com/dskwy11us/image/upload/v1727959923/logo2_4_1_usow6b.png" alt="LFReturnMe Logo">
-                    <h1>Password Reset Request</h1>
-                </div>
-                <div class="email-body">
-                    <p>To reset your password, please click the link below:</p>
-                    <p><a class="reset-link" href='{reset_link}'>{reset_link}</a><br>Link  expires after 5 minutes</p>
-                    <p>If you did not request a password reset, please ignore this email.</p>
-                </div>
-                <div class="email-footer">
-                    <p>Best regards,<br><strong>LFReturnMe Team</strong></p>
-                    <p>Connect with us on social media:</p>
-                    <div class="social-icons">
-                        <a href="https://www.instagram.com/lfreturnme" target="_blank">
-                            <img src="https://cdn-icons-png.flaticon.com/512/2111/2111463.png" alt="Instagram">
-                        </a>
-                        <a href="https://twitter.com/LFReturnMe1" target="_blank">
-                            <img src="https://res.cloudinary.com/dskwy11us/image/upload/v1729692730/X_tobavt.png" alt="X">  <!-- Updated Twitter logo to X -->
-                        </a>
-                        <a href="https://www.linkedin.com/company/lfreturnme" target="_blank">
-                            <img src="https://cdn-icons-png.flaticon.com/512/174/174857.png" alt="LinkedIn">
-                        </a>
-                        <a href="https://www.facebook.com/LFReturnMe" target="_blank">
-                            <img src="https://cdn-icons-png.flaticon.com/512/733/733547.png" alt="Facebook">
-                        </a>
-                    </div>
-                    <p>&copy; {datetime.now().year} LFReturnMe. All rights reserved.</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-    }
-
-    headers = {
-        'accept': 'application/json',
-        'api-key': brevo_api,  # Replace with your Brevo API key
-        'Content-Type': 'application/json',
+        "htmlContent": email_templates.render("password_reset.html", reset_link=reset_link)
     }
 
     # Send the POST request
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()  # Raises an HTTPError if the status is 4xx or 5xx
+        await email_transport.send(payload)
         print("Email sent successfully!")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         # Handle request exceptions (timeout, connection error, etc.)
         raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
 
@@ -812,26 +807,12 @@ async def get_active_subscriptions():
         return active_subscriptions
 
 
-def send_email_webhook(cleaned_email: str):
+async def send_email_webhook(cleaned_email: str):
     try:
-        # Example sending email logic using smtplib
-        sender_email = os.getenv("EMAIL_USER")  # Replace with your sender email
-        receiver_email = cleaned_email
-        subject = "Subscription Update"
-        body = f"Hello, your subscription has been updated successfully."
-
-        # Setup the email
-        msg = MIMEText(body)
-        msg["Subject"] = subject
-        msg["From"] = sender_email
-        msg["To"] = receiver_email
-
-        # Send the email
-        with smtplib.SMTP_SSL(os.getenv("EMAIL_HOST"), 465) as server:  # Replace with your SMTP server and port
-            server.login(sender_email, os.getenv("EMAIL_PASS"))  # Replace with your email password
-            server.sendmail(sender_email, receiver_email, msg.as_string())
-            server.quit()
-        logging.info(f"Email sent to {cleaned_email}")
+        # Queued on the pooled SMTP sessions; the webhook never waits on the handshake
+        smtp_mailer.submit(cleaned_email, "Subscription Update",
+                           "Hello, your subscription has been updated successfully.")
+        logging.info(f"Email queued for {cleaned_email}")
     except Exception as e:
         logging.error(f"Failed to send email: {str(e)}")
 
@@ -974,8 +955,8 @@ async def async_process(event_type, tag_id, email, data, background_tasks):
                         'Custom'
                     )
 
-                # Set subscription_end to 30 days
-                update_fields['subscription_end'] = 30
+                # Subscription runs for 30 days from now
+                update_fields['expires_at'] = datetime.utcnow() + SUBSCRIPTION_PERIOD
 
                 if email:
                     update_fields['email_address'] = email
@@ -986,22 +967,21 @@ async def async_process(event_type, tag_id, email, data, background_tasks):
                 logging.info("Subscription not renewed")
                 next_payment_date_str = data.get('next_payment_date')
                 if next_payment_date_str:
-                    # Parse the next_payment_date from string to datetime
-                    next_payment_date = parser.parse(next_payment_date_str).date()
-                    today = datetime.now().date()
-                    days_remaining = (next_payment_date - today).days
-                    days_remaining = max(days_remaining, 0)  # Ensure non-negative
-                    update_fields['subscription_end'] = days_remaining
+                    # The subscription stays valid until the payment that won't happen
+                    next_payment_date = parser.parse(next_payment_date_str)
+                    if next_payment_date.tzinfo:
+                        next_payment_date = next_payment_date.astimezone(timezone.utc).replace(tzinfo=None)
+                    update_fields['expires_at'] = next_payment_date
                 else:
                     logging.warning("next_payment_date not found in data")
-                    update_fields['subscription_end'] = 0  # Default to 0 days remaining
+                    update_fields['expires_at'] = datetime.utcnow()  # Expire now
 
                 if not email:
                     email = item.get('email_address')
 
             elif event_type == 'subscription.disable':
                 update_fields['subscription_status'] = 'cancelled'
-                update_fields['subscription_end'] = 0  # No days remaining
+                update_fields['expires_at'] = datetime.utcnow()  # No time remaining
 
                 if not email:
                     email = item.get('email_address')
@@ -1013,32 +993,17 @@ async def async_process(event_type, tag_id, email, data, background_tasks):
             # Update the item in the items collection
             await items_collection.update_one({'_id': item['_id']}, {'$set': update_fields})
 
-            # Fetch the updated item
-            updated_item = await items_collection.find_one({'_id': item['_id']})
-            if '_id' in updated_item:
-                del updated_item['_id']
-
-            logging.info(f"Updated item: {updated_item}")
+            logging.info(f"Updated item fields: {update_fields}")
 
             uuid = item.get('uuid')
             logging.info(f"uuid found: {uuid}")
             if uuid:
-                # Find the user in the users collection
-                user = await users_collection.find_one({'uuid': uuid})
-                if user:
-                    user_items = user.get('items', {})
-                    user_items = {str(k): v for k, v in user_items.items()}
-
-                    if tag_id in user_items:
-                        await users_collection.update_one(
-                            {'_id': user['_id']},
-                            {'$set': {f'items.{tag_id}': updated_item}}
-                        )
-                        logging.info(f"Updated user item for tag {tag_id} to match items collection.")
-                    else:
-                        logging.warning(f"Tag {tag_id} not found in user's items.")
+                # Mirror only the changed fields onto the user's copy of the item
+                result = await set_user_item_fields(uuid, tag_id, update_fields)
+                if result.matched_count:
+                    logging.info(f"Updated user item for tag {tag_id} to match items collection.")
                 else:
-                    logging.warning(f"User with uuid {uuid} not found.")
+                    logging.warning(f"Tag {tag_id} not found in items of user {uuid}.")
 
             # Ensure email is available before proceeding
             if email:
@@ -1061,86 +1026,190 @@ async def generate_code():
     return str(random.randint(1000000000, 9999999999))  # Generate 10-digit code
 
 
-async def save_access_code(uuid: str):
-    current_time = datetime.utcnow()
+def _cache_access_code(record: dict) -> Optional[str]:
+    if datetime.utcnow() - record["timestamp"] < ACCESS_CODE_TTL:
+        access_code_cache[record["uuid"]] = (record["code"], record["timestamp"])
+        return record["code"]
+    return None
 
-    # Search for existing code with the same uuid
-    existing_record = await access_collection.find_one({"uuid": uuid})
 
-    if existing_record:
-        # Check if the existing code was generated within the last 15 minutes
-        last_timestamp = existing_record["timestamp"]
-        if current_time - last_timestamp < timedelta(minutes=15):
-            # Return existing code if within 15 minutes
-            return existing_record["code"]
+def _cached_access_code(uuid: str) -> Optional[str]:
+    cached = access_code_cache.get(uuid)
+    if cached and datetime.utcnow() - cached[1] < ACCESS_CODE_TTL:
+        return cached[0]
+    return None
 
-        # Delete the existing record if it's older than 15 minutes
-        await access_collection.delete_one({"uuid": uuid})
 
-    # Generate new code and save to MongoDB
-    new_code = await generate_code()
-    await access_collection.insert_one({
-        "uuid": uuid,
-        "code": new_code,
-        "timestamp": current_time
-    })
+async def save_access_code(uuid: str):
+    cached_code = _cached_access_code(uuid)
+    if cached_code:
+        return cached_code
 
-    return new_code
+    current_time = datetime.utcnow()
+    cutoff = current_time - ACCESS_CODE_TTL
+    new_code = await generate_code()
+    is_fresh = {"$gt": ["$timestamp", cutoff]}
 
+    # Keep the stored code while it is fresh, otherwise replace it, all in one round trip.
+    # Stale records the upsert never touches again are removed by the TTL index.
+    def upsert_code():
+        return access_collection.find_one_and_update(
+            {"uuid": uuid},
+            [{"$set": {
+                "code": {"$cond": [is_fresh, "$code", {"$literal": new_code}]},
+                "timestamp": {"$cond": [is_fresh, "$timestamp", current_time]},
+            }}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
 
-async def update_subscriptions_daily(items_collection, users_collection):
     try:
-        # Decrement 'subscription_end' by 1 for all items where 'subscription_end' is greater than 0
-        await items_collection.update_many(
-            {'subscription_end': {'$gt': 0}},
-            {'$inc': {'subscription_end': -1}}
-        )
+        record = await upsert_code()
+    except DuplicateKeyError:
+        # A concurrent first request inserted the record; this time the filter matches it
+        record = await upsert_code()
 
-        # Set 'subscription_status' to 'inactive' where 'subscription_end' <= 0
-        await items_collection.update_many(
-            {'subscription_end': {'$lte': 0}},
-            {'$set': {'subscription_status': 'inactive'}}
-        )
+    _cache_access_code(record)
+    return record["code"]
 
-        # Fetch all users with items to update their subscriptions
-        users = await users_collection.find({"items": {"$exists": True}}).to_list(length=None)
 
-        for user in users:
-            uuid = user.get('uuid')
-            user_items = user.get('items', {})
+async def get_access_code(uuid: str):
+    # Read path for the dashboard: only writes when there is no fresh code to reuse
+    cached_code = _cached_access_code(uuid)
+    if cached_code:
+        return cached_code
 
-            if not user_items:
-                continue
+    record = await access_collection.find_one({"uuid": uuid})
+    if record:
+        code = _cache_access_code(record)
+        if code:
+            return code
 
-            user_update_operations = []
+    return await save_access_code(uuid)
 
-            for tag_id, user_item in user_items.items():
-                subscription_end = user_item.get('subscription_end', 0)
-                subscription_status = user_item.get('subscription_status', 'inactive')
 
-                # Only decrement if subscription_end is greater than 0
-                if subscription_end > 0:
-                    new_subscription_end = subscription_end - 1
-                else:
-                    new_subscription_end = 0  # Ensure subscription_end doesn't go below 0
+SUBSCRIPTION_PERIOD = timedelta(days=30)
+SUBSCRIPTION_BATCH_SIZE = 500
 
-                update_fields = {
-                    f'items.{tag_id}.subscription_end': new_subscription_end
-                }
+# Statuses the expiry sweep flips to 'inactive' once expires_at has passed
+LIVE_SUBSCRIPTION_STATUSES = ["active", "one-time", "cancelled"]
 
-                # If subscription_end <= 0, set subscription_status to 'inactive'
-                if new_subscription_end <= 0:
-                    update_fields[f'items.{tag_id}.subscription_status'] = 'inactive'
 
-                # Prepare the update operation
-                user_update_operations.append(UpdateOne(
-                    {'_id': user['_id']},
-                    {'$set': update_fields}
-                ))
+def with_subscription_state(item: dict, now: Optional[datetime] = None) -> dict:
+    # subscription_end (days left) and an expired status are derived from expires_at
+    # at read time, so nothing has to be rewritten as days pass
+    expires_at = item.get("expires_at")
+    if expires_at:
+        remaining = expires_at - (now or datetime.utcnow())
+        item["subscription_end"] = max(math.ceil(remaining.total_seconds() / 86400), 0)
+        if remaining.total_seconds() <= 0 and item.get("subscription_status") in LIVE_SUBSCRIPTION_STATUSES:
+            item["subscription_status"] = "inactive"
+    return item
 
-            # Execute bulk update for the user if there are updates
-            if user_update_operations:
-                await users_collection.bulk_write(user_update_operations)
+
+def with_subscription_states(items: dict) -> dict:
+    now = datetime.utcnow()
+    return {tag_id: with_subscription_state(item, now) for tag_id, item in items.items()}
+
+
+async def _expire_batch(items_collection, users_collection, batch: list, now: datetime):
+    expired_fields = {'subscription_status': 'inactive', 'subscription_end': 0}
+    result = await items_collection.update_many(
+        {'_id': {'$in': [item['_id'] for item in batch]}, 'expires_at': {'$lte': now}},
+        {'$set': expired_fields}
+    )
+
+    # Only flip the user's copy if it hasn't been renewed in the meantime
+    user_updates = [
+        UpdateOne(
+            {'uuid': item['uuid'], _user_item_path(item['tag_id'], 'expires_at'): {'$lte': now}},
+            {'$set': {_user_item_path(item['tag_id'], field): value for field, value in expired_fields.items()}}
+        )
+        for item in batch if item.get('uuid')
+    ]
+    users_modified = 0
+    if user_updates:
+        users_result = await users_collection.bulk_write(user_updates, ordered=False)
+        users_modified = users_result.modified_count
+
+    return result.modified_count, users_modified
+
+
+async def update_subscriptions_daily(items_collection, users_collection, dry_run: bool = False,
+                                     batch_size: int = SUBSCRIPTION_BATCH_SIZE) -> dict:
+    # Sweeps only subscriptions that expired since they were last flipped, using the
+    # (subscription_status, expires_at) index, so the cost scales with expiries
+    start_time = time.monotonic()
+    now = datetime.utcnow()
+    query = {'subscription_status': {'$in': LIVE_SUBSCRIPTION_STATUSES}, 'expires_at': {'$lte': now}}
+    report = {"dry_run": dry_run, "items_matched": 0, "items_modified": 0, "users_modified": 0}
+    try:
+        if dry_run:
+            report["items_matched"] = await items_collection.count_documents(query)
+            return report
+
+        batch = []
+        cursor = items_collection.find(query, {'tag_id': 1, 'uuid': 1}, batch_size=batch_size)
+        async for item in cursor:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                items_modified, users_modified = await _expire_batch(items_collection, users_collection, batch, now)
+                report["items_matched"] += len(batch)
+                report["items_modified"] += items_modified
+                report["users_modified"] += users_modified
+                batch = []
+
+        if batch:
+            items_modified, users_modified = await _expire_batch(items_collection, users_collection, batch, now)
+            report["items_matched"] += len(batch)
+            report["items_modified"] += items_modified
+            report["users_modified"] += users_modified
+
+        return report
 
     except Exception as e:
         logging.error(f"Error in update_subscriptions_daily: {str(e)}")
+        report["error"] = str(e)
+        return report
+    finally:
+        report["duration_seconds"] = round(time.monotonic() - start_time, 3)
+        logging.info(f"update_subscriptions_daily finished: {report}")
+
+
+def _user_items_with_expiry():
+    # Converts day countdowns on users' item copies to absolute expires_at
+    countdown = {"$ifNull": ["$$item.v.subscription_end", 0]}
+    return [{"$set": {"items": {"$arrayToObject": {"$map": {
+        "input": {"$objectToArray": "$items"},
+        "as": "item",
+        "in": {
+            "k": "$$item.k",
+            "v": {"$cond": [
+                {"$and": [{"$gt": [countdown, 0]}, {"$eq": [{"$type": "$$item.v.expires_at"}, "missing"]}]},
+                {"$mergeObjects": ["$$item.v", {"expires_at": {"$add": ["$$NOW", {"$multiply": [countdown, 86400000]}]}}]},
+                "$$item.v",
+            ]},
+        },
+    }}}}}]
+
+
+async def migrate_subscription_countdowns():
+    # One-off conversion of stored subscription_end day counts to expires_at,
+    # recorded in the migrations collection so later startups skip it
+    if await migrations_collection.find_one({"_id": "subscription_expires_at"}):
+        return
+
+    items_result = await items_collection.update_many(
+        {'expires_at': {'$exists': False}, 'subscription_end': {'$gt': 0}},
+        [{'$set': {'expires_at': {'$add': ['$$NOW', {'$multiply': ['$subscription_end', 86400000]}]}}}]
+    )
+    users_result = await users_collection.update_many(
+        {"items": {"$type": "object", "$ne": {}}}, _user_items_with_expiry())
+
+    await migrations_collection.update_one(
+        {"_id": "subscription_expires_at"},
+        {"$set": {"applied_at": datetime.utcnow()}},
+        upsert=True
+    )
+    logging.info(f"Migrated subscription countdowns: {items_result.modified_count} items, "
+                 f"{users_result.modified_count} users")
@@ -0,0 +1,76 @@
+import logging
+import os
+import re
+from datetime import datetime
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import Markup
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "email")
+
+_COMMENT_RE = re.compile(r"<!--.*?-->|/\*.*?\*/", re.S)
+_WHITESPACE_RE = re.compile(r"\s+")
+_BETWEEN_TAGS_RE = re.compile(r">\s+<")
+_CSS_PUNCTUATION_RE = re.compile(r"\s*([{};:,])\s*")
+_STYLE_RE = re.compile(r"(<style>|{% block styles %})(.*?)(</style>|{% endblock %})", re.S)
+
+
+def minify_html(source: str) -> str:
+    # Safe for our email markup: no <pre> blocks and no whitespace-sensitive inline runs
+    source = _COMMENT_RE.sub("", source)
+    source = _WHITESPACE_RE.sub(" ", source)
+    source = _BETWEEN_TAGS_RE.sub("><", source)
+    source = _STYLE_RE.sub(lambda m: m.group(1) + _CSS_PUNCTUATION_RE.sub(r"\1", m.group(2)).strip() + m.group(3),
+                           source)
+    return source.strip()
+
+
+class MinifyingLoader(FileSystemLoader):
+    # Minifies template sources as Jinja loads them, so it happens once per template
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        return minify_html(source), filename, uptodate
+
+
+class EmailTemplates:
+    # Compiles every email template once and keeps them for the life of the process.
+    # Static layout markup is compiled into constant chunks, and fully static fragments
+    # (templates starting with "_") are rendered once and reused, so a render only
+    # fills in the per-message variables.
+
+    def __init__(self, template_dir: str):
+        self.env = Environment(
+            loader=MinifyingLoader(template_dir),
+            autoescape=select_autoescape(["html"]),
+            auto_reload=False,
+            cache_size=-1,
+        )
+        self._templates = {}
+        self._fragments = {}
+
+    def load(self):
+        if self._templates:
+            return
+        for name in self.env.list_templates(extensions=["html"]):
+            self._templates[name] = self.env.get_template(name)
+        logger.info("Compiled %d email templates", len(self._templates))
+
+    def fragment(self, template_name: str, year: int) -> Markup:
+        key = (template_name, year)
+        if key not in self._fragments:
+            self._fragments[key] = Markup(self._templates[template_name].render(year=year))
+        return self._fragments[key]
+
+    def render(self, template_name: str, /, **context) -> str:
+        # Positional-only so templates can use a `name` variable
+        if not self._templates:
+            self.load()
+        year = context.setdefault("year", datetime.utcnow().year)
+        context["social_footer"] = self.fragment("_social.html", year)
+        return self._templates[template_name].render(**context)
+
+
+email_templates = EmailTemplates(TEMPLATE_DIR)
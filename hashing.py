@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import bcrypt
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+# Number of worker processes doing bcrypt work, defaults to one per core
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+# Jobs allowed to be running or waiting for a worker before we shed load with 503
+HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", HASH_WORKERS * 8))
+
+
+def _hash_password(password: bytes) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt())
+
+
+def _check_password(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordHasher:
+    # Runs bcrypt in a process pool so hashing never blocks the event loop.
+    # The pool is created lazily and uses "spawn" so children don't inherit
+    # the motor/firebase threads of the API process.
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = max(workers, 1)
+        self.queue_size = max(queue_size, 1)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            logger.info("Password hashing pool started with %d workers", self.workers)
+        return self._executor
+
+    async def _submit(self, fn, *args):
+        if self._pending >= self.queue_size:
+            logger.warning("Password hashing queue full (%d pending)", self._pending)
+            raise HTTPException(status_code=503, detail="Server busy, please try again",
+                                headers={"Retry-After": "1"})
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        hashed = await self._submit(_hash_password, password.encode('utf-8'))
+        return hashed.decode('utf-8')
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._submit(_check_password, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def start(self):
+        self._get_executor()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class ConcurrencyLimit:
+    # FastAPI dependency capping how many requests a route handles at once,
+    # e.g. `Depends(ConcurrencyLimit(32))`. Excess requests get a 503 instead of
+    # piling up behind the hashing pool.
+
+    def __init__(self, limit: int):
+        self.limit = max(limit, 1)
+        self._active = 0
+
+    async def __call__(self):
+        if self._active >= self.limit:
+            raise HTTPException(status_code=503, detail="Server busy, please try again",
+                                headers={"Retry-After": "1"})
+        self._active += 1
+        try:
+            yield
+        finally:
+            self._active -= 1
+
+
+password_hasher = PasswordHasher(HASH_WORKERS, HASH_QUEUE_SIZE)
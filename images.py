@@ -0,0 +1,89 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+    PILLOW_AVAILABLE = True
+except ImportError:
+    PILLOW_AVAILABLE = False
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 80))
+IMAGE_FORMAT = "WEBP"
+IMAGE_CONTENT_TYPE = "image/webp"
+# Longest edge in pixels for each stored variant
+IMAGE_VARIANTS = {"thumb": 160, "card": 480, "full": 1600}
+# Refuse anything that would decode to more than ~40 megapixels
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 40_000_000))
+
+
+def _normalize(data: bytes) -> Dict[str, bytes]:
+    # Runs in a worker process: decode once, drop EXIF (after applying its
+    # orientation), then downscale and re-encode every variant from the same pixels
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    with Image.open(io.BytesIO(data)) as image:
+        # Lets JPEG decode at a reduced scale when the source is far bigger than we keep
+        longest = max(IMAGE_VARIANTS.values())
+        image.draft("RGB", (longest, longest))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    variants = {}
+    for name, edge in sorted(IMAGE_VARIANTS.items(), key=lambda variant: -variant[1]):
+        image.thumbnail((edge, edge), Image.LANCZOS)
+        out = io.BytesIO()
+        # Saved without exif/icc info, so no location or device metadata is kept
+        image.save(out, IMAGE_FORMAT, quality=IMAGE_QUALITY, method=4)
+        variants[name] = out.getvalue()
+    return variants
+
+
+class ImageProcessor:
+    # Decodes and re-encodes uploaded photos in a process pool, same setup as the
+    # password hashing pool. Without Pillow installed images are stored as uploaded.
+
+    def __init__(self, workers: int):
+        self.workers = max(workers, 1)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def available(self) -> bool:
+        return PILLOW_AVAILABLE
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            logger.info("Image processing pool started with %d workers", self.workers)
+        return self._executor
+
+    async def normalize(self, data: bytes) -> Dict[str, bytes]:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_executor(), _normalize, data)
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+            logger.warning("Rejected image upload: %s", e)
+            raise HTTPException(status_code=400, detail="Unsupported or corrupt image")
+
+    def start(self):
+        if self.available:
+            self._get_executor()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+image_processor = ImageProcessor(IMAGE_WORKERS)
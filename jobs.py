@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from crud import db
+
+logger = logging.getLogger(__name__)
+
+job_locks_collection = db["job_locks"]
+job_runs_collection = db["job_runs"]
+
+LEASE_TTL = timedelta(seconds=int(os.getenv("JOB_LEASE_TTL_SECONDS", 60)))
+
+# Identifies this process as a lease holder
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class LeaderLease:
+    # Mongo-backed lease: one document per job name. Every successful acquire
+    # bumps a token that is handed to the job. Only writes that filter on it are
+    # fenced (run_daily_job's run record); otherwise a job that loses the lease is
+    # cancelled, so its own writes must be safe to repeat.
+
+    def __init__(self, name: str, ttl: timedelta = LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self.token: Optional[int] = None
+
+    async def acquire(self) -> Optional[int]:
+        now = datetime.utcnow()
+        try:
+            lease = await job_locks_collection.find_one_and_update(
+                {"_id": self.name, "$or": [{"expires_at": {"$lte": now}}, {"owner": WORKER_ID}]},
+                {"$set": {"owner": WORKER_ID, "expires_at": now + self.ttl, "acquired_at": now},
+                 "$inc": {"token": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The lease exists and is held by someone else
+            return None
+
+        self.token = lease["token"]
+        return self.token
+
+    async def renew(self) -> bool:
+        result = await job_locks_collection.update_one(
+            {"_id": self.name, "owner": WORKER_ID, "token": self.token},
+            {"$set": {"expires_at": datetime.utcnow() + self.ttl}}
+        )
+        return result.matched_count > 0
+
+    async def release(self):
+        await job_locks_collection.update_one(
+            {"_id": self.name, "owner": WORKER_ID, "token": self.token},
+            {"$set": {"expires_at": datetime.utcnow()}}
+        )
+        self.token = None
+
+    async def _heartbeat(self, job: asyncio.Task, lost: asyncio.Event):
+        while not job.done():
+            await asyncio.sleep(self.ttl.total_seconds() / 3)
+            try:
+                renewed = await self.renew()
+            except Exception as e:
+                logger.error("Lease heartbeat failed for %s: %s", self.name, e)
+                renewed = False
+            if not renewed:
+                logger.error("Lost lease for %s, cancelling job", self.name)
+                lost.set()
+                job.cancel()
+                return
+
+    async def run(self, job_fn: Callable[[int], Awaitable]):
+        # Runs job_fn(token) while holding the lease; returns None without running
+        # when another worker holds it. Raises LeaseLost (not CancelledError, which
+        # would stop the caller's own loop) if the lease is lost midway.
+        token = await self.acquire()
+        if token is None:
+            logger.info("Lease for %s held by another worker, skipping", self.name)
+            return None
+
+        lost = asyncio.Event()
+        job = asyncio.create_task(job_fn(token))
+        heartbeat = asyncio.create_task(self._heartbeat(job, lost))
+        try:
+            return await job
+        except asyncio.CancelledError:
+            if lost.is_set():
+                raise LeaseLost(f"Lost lease for {self.name}")
+            raise
+        finally:
+            heartbeat.cancel()
+            await self.release()
+
+
+class BackgroundTask:
+    # A service driven by one long-running run() coroutine, started and stopped
+    # with the app
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        raise NotImplementedError
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class PeriodicLeasedTask(BackgroundTask):
+    # Calls job_fn every interval seconds on whichever worker holds the lease.
+    # job_fn doesn't get the lease token, so its writes aren't fenced: it must be
+    # safe to repeat, and is cancelled if another worker takes the lease. Failures
+    # are logged and the work is picked up again on the next round.
+
+    def __init__(self, name: str, interval: float, job_fn: Callable[[], Awaitable]):
+        super().__init__()
+        self.name = name
+        self.interval = interval
+        self._job_fn = job_fn
+        self._lease = LeaderLease(name)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._lease.run(lambda token: self._job_fn())
+            except asyncio.CancelledError:
+                raise
+            except LeaseLost as e:
+                logger.warning("%s", e)
+            except Exception as e:
+                logger.error("%s failed: %s", self.name, e)
+
+
+async def run_daily_job(name: str, job_fn: Callable[[], Awaitable[dict]], day: Optional[str] = None) -> dict:
+    # Runs job_fn at most once per UTC day across all workers. Scheduled and manual
+    # triggers both go through here, so repeats on the same day are no-ops.
+    day = day or datetime.utcnow().strftime("%Y-%m-%d")
+    run_id = f"{name}:{day}"
+
+    async def guarded(token: int):
+        existing = await job_runs_collection.find_one({"_id": run_id}, {"status": 1})
+        if existing and existing.get("status") == "completed":
+            logger.info("%s already completed for %s, skipping", name, day)
+            return {"skipped": True, "reason": "already completed", "day": day}
+
+        await job_runs_collection.update_one(
+            {"_id": run_id},
+            {"$set": {"job": name, "day": day, "status": "running", "token": token,
+                      "worker": WORKER_ID, "started_at": datetime.utcnow()}},
+            upsert=True
+        )
+        report = await job_fn()
+
+        # Fenced: a worker whose lease was taken over can't mark the run as done
+        await job_runs_collection.update_one(
+            {"_id": run_id, "token": token},
+            {"$set": {"status": "failed" if report.get("error") else "completed",
+                      "finished_at": datetime.utcnow(), "report": report}}
+        )
+        return report
+
+    result = await LeaderLease(name).run(guarded)
+    if result is None:
+        return {"skipped": True, "reason": "another worker holds the lease", "day": day}
+    return result
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import os
+import smtplib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from typing import List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401  httpx only negotiates HTTP/2 when h2 is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+BREVO_BASE_URL = "https://api.brevo.com/v3"
+EMAIL_MAX_CONCURRENCY = int(os.getenv("EMAIL_MAX_CONCURRENCY", 20))
+EMAIL_TIMEOUT = httpx.Timeout(float(os.getenv("EMAIL_TIMEOUT_SECONDS", 10)), connect=5.0)
+
+
+class EmailTransport:
+    # One pooled, keep-alive AsyncClient per worker for every Brevo call, with a cap
+    # on how many requests are in flight at once
+
+    def __init__(self, base_url: str, max_concurrency: int):
+        self.base_url = base_url
+        self.max_concurrency = max(max_concurrency, 1)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={
+                    "accept": "application/json",
+                    "api-key": os.getenv("BREVO_API") or "",
+                    "content-type": "application/json",
+                },
+                http2=HTTP2_AVAILABLE,
+                timeout=EMAIL_TIMEOUT,
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency),
+            )
+        return self._client
+
+    async def post(self, path: str, payload: dict) -> dict:
+        async with self._slots:
+            response = await self.client.post(path, json=payload)
+        response.raise_for_status()  # Raises an HTTPStatusError if the status is 4xx or 5xx
+        return response.json() if response.content else {}
+
+    async def send(self, payload: dict) -> dict:
+        return await self.post("/smtp/email", payload)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+email_transport = EmailTransport(BREVO_BASE_URL, EMAIL_MAX_CONCURRENCY)
+
+
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 2))
+SMTP_BATCH_SIZE = int(os.getenv("SMTP_BATCH_SIZE", 50))
+SMTP_IDLE_SECONDS = float(os.getenv("SMTP_IDLE_SECONDS", 60))
+
+
+class SMTPConnection:
+    # One authenticated SMTP_SSL session, reused across messages and reopened when
+    # the server drops it or it has sat idle long enough to be dropped
+
+    def __init__(self, host: str, port: int, user: str, password: str):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self._server: Optional[smtplib.SMTP_SSL] = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        self.close()
+        self._server = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
+        self._server.login(self.user, self.password)
+        logger.info("Opened SMTP session to %s", self.host)
+
+    def _ensure(self):
+        if self._server is None or time.monotonic() - self._last_used > SMTP_IDLE_SECONDS:
+            self._connect()
+
+    def send_many(self, messages: List[EmailMessage]) -> int:
+        # Runs in a worker thread; all messages go over the same session
+        sent = 0
+        for message in messages:
+            for attempt in range(2):
+                try:
+                    self._ensure()
+                    self._server.send_message(message)
+                    self._last_used = time.monotonic()
+                    sent += 1
+                    break
+                except OSError as e:
+                    # SMTPException subclasses OSError; only session-level errors and
+                    # socket errors are worth a reconnect, the rest reject this message
+                    if isinstance(e, smtplib.SMTPException) and not isinstance(
+                        e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)
+                    ):
+                        logger.error("Failed to send email to %s: %s", message["To"], e)
+                        break
+                    # Stale or broken session: reconnect and retry this message once
+                    logger.warning("SMTP session to %s failed, reconnecting: %s", self.host, e)
+                    self._server = None
+                    if attempt:
+                        logger.error("Failed to send email to %s: %s", message["To"], e)
+        return sent
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+
+class SMTPMailer:
+    # Queues messages and hands them to a fixed set of pooled SMTP sessions, each
+    # driven from its own thread, so callers never wait on handshakes or AUTH
+
+    def __init__(self, pool_size: int, batch_size: int):
+        self.pool_size = max(pool_size, 1)
+        self.batch_size = max(batch_size, 1)
+        self._queue: Optional[asyncio.Queue] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._connections: List[SMTPConnection] = []
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def sender(self) -> str:
+        return os.getenv("EMAIL_USER") or ""
+
+    def submit(self, to_email: str, subject: str, body: str):
+        message = EmailMessage()
+        message["Subject"] = subject
+        message["From"] = self.sender
+        message["To"] = to_email
+        message.set_content(body)
+
+        if self._queue is None:
+            self.start()
+        self._queue.put_nowait(message)
+
+    async def _consume(self, connection: SMTPConnection):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                sent = await loop.run_in_executor(self._executor, connection.send_many, batch)
+                logger.info("Sent %d of %d emails over SMTP", sent, len(batch))
+            except Exception as e:
+                logger.error("SMTP batch failed: %s", e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="smtp")
+        for _ in range(self.pool_size):
+            connection = SMTPConnection(os.getenv("EMAIL_HOST"), 465, self.sender, os.getenv("EMAIL_PASS"))
+            self._connections.append(connection)
+            self._tasks.append(asyncio.create_task(self._consume(connection)))
+
+    async def stop(self, timeout: float = 10):
+        if self._queue is None:
+            return
+        try:
+            # Give queued messages a chance to go out before shutting the sessions
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %d unsent SMTP messages on shutdown", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        for connection in self._connections:
+            connection.close()
+        self._executor.shutdown(wait=False)
+        self._queue, self._executor, self._connections, self._tasks = None, None, [], []
+
+
+smtp_mailer = SMTPMailer(SMTP_POOL_SIZE, SMTP_BATCH_SIZE)
@@ -1,5 +1,5 @@
+import asyncio
 from typing import Optional, Dict, List
-import requests
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import Form, UploadFile, File, BackgroundTasks, Request
 from datetime import datetime, timedelta
@@ -7,15 +7,31 @@ from pydantic import EmailStr
 import schemas
 import crud
 from schemas import ItemRegistration, LostFound
-from crud import get_tag_by_tag1, update_tag, save_item_registration, update_user_items, upload_to_firebase, send_email
+from crud import save_item_registration, update_user_items
 from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import logging
 import time
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Depends, Header
 import json
+import os
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from crud import update_subscriptions_daily  # Import the function from crud.py
+from hashing import password_hasher, ConcurrencyLimit
+import jobs
+from mailer import email_transport, smtp_mailer
+import outbox
+from email_templates import email_templates
+from newsletter import newsletter_sync
+import uploads
+from uploads import upload_service
+from images import image_processor
+import blob_gc
+from blob_gc import blob_sweeper
+from tags import tag_resolver
+import tag_import
+import hmac
+from pymongo.errors import DuplicateKeyError
 
 app = FastAPI()
 # (docs_url=None, redoc_url=None, openapi_url=None
@@ -29,14 +45,66 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 scheduler = AsyncIOScheduler()
 
 logging.basicConfig(level=logging.INFO)
 
+# Per-route caps on concurrent requests that need bcrypt work
+signup_limit = ConcurrencyLimit(int(os.getenv("SIGNUP_CONCURRENCY", 16)))
+signin_limit = ConcurrencyLimit(int(os.getenv("SIGNIN_CONCURRENCY", 64)))
+reset_password_limit = ConcurrencyLimit(int(os.getenv("RESET_PASSWORD_CONCURRENCY", 16)))
+# Each batch lookup can carry hundreds of tags
+tag_lookup_limit = ConcurrencyLimit(int(os.getenv("TAG_LOOKUP_CONCURRENCY", 32)))
+
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+
+
+def check_tag_id(tag_id: str):
+    if not crud.is_valid_tag_id(tag_id):
+        raise HTTPException(status_code=400, detail="Invalid tag ID")
+
+
+async def require_admin(x_admin_key: Optional[str] = Header(None)):
+    # Admin routes are disabled unless ADMIN_API_KEY is set
+    if not ADMIN_API_KEY or not x_admin_key or not hmac.compare_digest(x_admin_key, ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+# Comma-separated keys issued to partners; /tags/lookup is disabled while none are set
+PARTNER_API_KEYS = [key.strip() for key in os.getenv("PARTNER_API_KEYS", "").split(",") if key.strip()]
+# Tag codes each partner key may look up per minute, per worker
+TAG_LOOKUP_RATE_PER_MINUTE = int(os.getenv("TAG_LOOKUP_RATE_PER_MINUTE", 5000))
+tag_lookup_usage: Dict[str, List[float]] = {}
+
+
+async def require_partner(x_partner_key: Optional[str] = Header(None)) -> str:
+    if not x_partner_key or not any(hmac.compare_digest(x_partner_key, key) for key in PARTNER_API_KEYS):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return x_partner_key
+
+
+def charge_tag_lookups(partner_key: str, count: int):
+    # Fixed one-minute window per key: [window start, codes looked up in it]
+    now = time.monotonic()
+    usage = tag_lookup_usage.get(partner_key)
+    if usage is None or now - usage[0] >= 60:
+        usage = tag_lookup_usage[partner_key] = [now, 0]
+    if usage[1] + count > TAG_LOOKUP_RATE_PER_MINUTE:
+        retry_after = max(int(60 - (now - usage[0])), 1)
+        raise HTTPException(status_code=429, detail="Tag lookup rate limit exceeded",
+                            headers={"Retry-After": str(retry_after)})
+    usage[1] += count
+
 
 async def scheduled_task():
-    await update_subscriptions_daily(crud.items_collection, crud.users_collection)
+    # Every worker schedules this, but the lease and the per-day run record make sure
+    # only one of them does the work, once per day
+    await jobs.run_daily_job(
+        "update_subscriptions_daily",
+        lambda: update_subscriptions_daily(crud.items_collection, crud.users_collection)
+    )
 
 
 # Schedule the task to run every day at midnight
@@ -45,23 +113,88 @@ scheduler.add_job(scheduled_task, 'cron', hour=0, minute=0)
 
 @app.on_event("startup")
 async def startup_event():
+    await crud.ensure_indexes()
+    await crud.migrate_subscription_countdowns()
+    await outbox.ensure_indexes()
+    await uploads.ensure_indexes()
+    await blob_gc.ensure_indexes()
+    email_templates.load()
+    outbox.outbox_worker.start()
+    smtp_mailer.start()
+    newsletter_sync.start()
+    tag_resolver.start()
+    blob_sweeper.start()
+    password_hasher.start()
+    image_processor.start()
     scheduler.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     scheduler.shutdown()
+    await outbox.outbox_worker.stop()
+    await smtp_mailer.stop()
+    await newsletter_sync.stop()
+    await tag_resolver.stop()
+    await blob_sweeper.stop()
+    password_hasher.shutdown()
+    upload_service.shutdown()
+    image_processor.shutdown()
+    await email_transport.aclose()
 
 
 @app.get("/schedule-task")
-async def run_task(background_tasks: BackgroundTasks):
+async def run_task(background_tasks: BackgroundTasks, dry_run: bool = Query(False)):
+    if dry_run:
+        # Nothing is written, so report the counts straight away
+        return await update_subscriptions_daily(crud.items_collection, crud.users_collection, dry_run=True)
+
     background_tasks.add_task(scheduled_task)
     return {"message": "Task scheduled"}
 
 
-@app.post("/signup/", response_model=schemas.ResponseSignup)
+@app.post("/uploads/signed-url", response_model=schemas.SignedUpload)
+async def create_signed_upload(request: schemas.SignedUploadRequest):
+    # Step one of a direct upload: PUT the file to upload_url with the returned headers,
+    # then send object_name in the matching *_upload field of the form that uses it
+    return await upload_service.sign_upload(request.purpose, request.content_type)
+
+
+@app.get("/metrics/uploads")
+async def upload_metrics():
+    return upload_service.metrics.snapshot()
+
+
+@app.post("/tags/lookup", response_model=List[schemas.TagLookupResult], dependencies=[Depends(tag_lookup_limit)])
+async def lookup_tags(request: schemas.TagLookupRequest, partner_key: str = Depends(require_partner)):
+    # Resolve a whole bin of scanned tags in one request. Codes the Bloom filter
+    # knows were never provisioned are answered without querying. Results carry item
+    # details, so callers need a partner key and each key has a rate of codes.
+    charge_tag_lookups(partner_key, len(request.tag_ids))
+    known = [tag_id for tag_id in request.tag_ids if tag_resolver.may_exist(tag_id)]
+    results = {result["tag_id"]: result for result in await crud.lookup_tags(known)} if known else {}
+    return [results.get(tag_id, {"tag_id": tag_id, "registered": False}) for tag_id in request.tag_ids]
+
+
+@app.post("/admin/tags/import", dependencies=[Depends(require_admin)])
+async def import_tags(
+        request: Request,
+        fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+        batch_size: int = Query(tag_import.TAG_IMPORT_BATCH_SIZE, ge=1, le=10000),
+):
+    # The raw body (not a multipart form) is read as a stream, so memory stays flat
+    # whatever the size of the batch file
+    return await tag_import.import_tags(tag_import.lines_from_chunks(request.stream()), fmt, batch_size,
+                                        on_inserted=tag_resolver.provisioned)
+
+
+@app.get("/metrics/tags")
+async def tag_metrics():
+    return tag_resolver.stats()
+
+
+@app.post("/signup/", response_model=schemas.ResponseSignup, dependencies=[Depends(signup_limit)])
 async def signup(
-        background_tasks: BackgroundTasks,
         full_name: str = Form(...),
         email_address: str = Form(...),
         date_of_birth: str = Form(...),
@@ -69,125 +202,67 @@ async def signup(
         phone_number: str = Form(...),
         gender: str = Form(...),
         password: str = Form(...),
-        profile_picture: UploadFile = File(...),
+        profile_picture: UploadFile = File(None),
+        # Object name from /uploads/signed-url, instead of sending the file here
+        profile_picture_upload: Optional[str] = Form(None),
 
 ):
+    if profile_picture is None and not profile_picture_upload:
+        raise HTTPException(status_code=400, detail="A profile picture is required")
     try:
         date_of_birth_obj = datetime.strptime(date_of_birth, "%Y-%m-%d").date()
         email_address = email_address.lower()
 
+        # Reject known emails before paying for the upload and the hash
+        if not await crud.check_credentials(email_address):
+            raise HTTPException(status_code=400, detail="Email address already exists")
+
         # Upload files to Firebase
-        profile_picture_url = upload_to_firebase(profile_picture, "profile_picture")
+        profile_picture_url, profile_picture_variants = await upload_service.receive_image(
+            profile_picture, profile_picture_upload, "profile_picture")
         # id_card_image_url = upload_to_firebase(id_card_image)
 
-        user = schemas.Signup(
-            full_name=full_name,
-            email_address=email_address,
-            date_of_birth=date_of_birth_obj,
-            address=address,
-            # id_no=id_no,
-            phone_number=phone_number,
-            gender=gender,
-            # valid_id_type=valid_id_type,
-            profile_picture=profile_picture_url,
-            # id_card_image=id_card_image_url,
-            password=password,
-            is_verified=False,
-
-        )
+        db_user = None
+        try:
+            user = schemas.Signup(
+                full_name=full_name,
+                email_address=email_address,
+                date_of_birth=date_of_birth_obj,
+                address=address,
+                # id_no=id_no,
+                phone_number=phone_number,
+                gender=gender,
+                # valid_id_type=valid_id_type,
+                profile_picture=profile_picture_url,
+                profile_picture_variants=profile_picture_variants,
+                # id_card_image=id_card_image_url,
+                password=password,
+                is_verified=False,
+
+            )
+
+            db_user = await crud.create_user(user=user)
+        finally:
+            if db_user is None:
+                # Lost the race on the unique index or failed midway, drop the orphaned blob
+                await upload_service.release(profile_picture_url)
 
-        db_user = await crud.create_user(user=user)
-        body = f"""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Welcome to LFReturnMe</title>
-        <style>
-            body {{
-                font-family: Arial, sans-serif;
-                background-color: #f4f4f4;
-                margin: 0;
-                padding: 0;
-            }}
-            .container {{
-                max-width: 600px;
-                margin: 20px auto;
-                background-color: #ffffff;
-                padding: 20px;
-                border-radius: 10px;
-                box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
-            }}
-            .header {{
-                background-color: #ff6600;
-                padding: 10px 20px;
-                border-radius: 10px 10px 0 0;
-                text-align: center;
-                color: #ffffff;
-            }}
-            h1 {{
-                margin: 0;
-                font-size: 24px;
-            }}
-            .content {{
-                padding: 20px;
-                color: #333333;
-            }}
-            p {{
-                line-height: 1.6;
-            }}
-            a.button {{
-                display: inline-block;
-                padding: 10px 20px;
-                margin: 20px 0;
-                background-color: #ff6600;
-                color: #ffffff;
-                text-decoration: none;
-                border-radius: 5px;
-                font-size: 16px;
-            }}
-            .footer {{
-                margin-top: 20px;
-                text-align: center;
-                color: #888888;
-                font-size: 12px;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="content">
-                <p>Dear {user.full_name},</p>
-                <p>Welcome to LFReturnMe – your first step towards safeguarding your valuables and joining our growing community of Finders!</p>
-                <p>We’re thrilled to have you on board. Here’s a quick rundown of what you can expect from your experience with us:</p>
-                <ul>
-                    <li><strong>Peace of Mind:</strong> With our innovative tagging system, your valuable items can always find their way back to you if lost.</li>
-                    <li><strong>Finders Community:</strong> You are now part of a network that helps people recover their lost belongings. Earn rewards when you help others!</li>
-                    <li><strong>Quick Setup:</strong> You can start registering your valuable items right away! Simply log in to your account and add details about the items you want to protect.</li>
-                </ul>
-                <p>Explore the full benefits of your plan and get the most out of your LFReturnMe experience by visiting your dashboard today.</p>
-                <a href="www.lfreturnme.com/signin" class="button">Log in to your account</a>
-                <p>If you have any questions or need support, we’re always here for you. Reach out to our team.</p>
-                <p>Thank you for trusting LFReturnMe to keep you connected with your valuables.</p>
-            </div>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
         if db_user:
-            background_tasks.add_task(crud.send_email, user.email_address, "Welcome to LFReturnMe", body)
+            await outbox.enqueue_email(user.email_address, "Welcome to LFReturnMe",
+                                       email_templates.render("welcome.html", full_name=user.full_name),
+                                       f"welcome:{db_user.uuid}")
             return db_user
         else:
             raise HTTPException(status_code=400, detail="Email address already exists")
+    except HTTPException:
+        raise
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=f"Invalid date format: {ve}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/signin/", response_model=schemas.ResponseSignup)
+@app.post("/signin/", response_model=schemas.ResponseSignup, dependencies=[Depends(signin_limit)])
 async def signin(user: schemas.Signin):
     try:
         user.email_address = user.email_address.lower()
@@ -205,47 +280,80 @@ async def register_item(
         item_type: str = Form(...),
         item_name: str = Form(...),
         tag_id: str = Form(...),
-        item_image: UploadFile = File(...),
+        item_image: UploadFile = File(None),
         item_description: str = Form(...),
         uuid: str = Form(...),
+        item_image_upload: Optional[str] = Form(None),
 
 ):
-    tag = await get_tag_by_tag1(tag_id)
-    if not tag:
+    if item_image is None and not item_image_upload:
+        raise HTTPException(status_code=400, detail="An item image is required")
+
+    check_tag_id(tag_id)
+    # Codes that were never provisioned are turned away without a round trip
+    if not tag_resolver.may_exist(tag_id):
         raise HTTPException(status_code=404, detail="Tag not found")
 
-    if tag.is_owned:
+    # Claim the tag before paying for the upload; the owner check rides along
+    claimed, owner_exists = await asyncio.gather(crud.claim_tag(tag_id, uuid), crud.user_exists(uuid),
+                                                 return_exceptions=True)
+    if isinstance(owner_exists, BaseException):
+        # The claim may still have landed; give it back before failing
+        if claimed is not None and not isinstance(claimed, BaseException):
+            await crud.release_tag(tag_id, uuid, claimed.get("uuid"))
+        raise owner_exists
+    if isinstance(claimed, BaseException):
+        raise claimed
+    if claimed is None:
+        # Only the failure path reads the tag, to tell a missing tag from an owned one
+        if await tag_resolver.get(tag_id) is None:
+            raise HTTPException(status_code=404, detail="Tag not found")
         raise HTTPException(status_code=400, detail="This tag is already owned")
+    tag_resolver.invalidate(tag_id)
 
-    # Upload image to Firebase
-    image_url = upload_to_firebase(item_image, "item_images")
-
-    now = datetime.now()
-    date_string = now.strftime("%Y-%m-%d")
-    registered_date_obj = datetime.strptime(date_string, "%Y-%m-%d").date()
-    registered_date_str = registered_date_obj.strftime("%Y-%m-%d")
-
-    # Save item registration
-    item = ItemRegistration(
-        item_id=item_id,
-        item_type=item_type,
-        item_name=item_name,
-        tag_id=tag_id,
-        item_image=image_url,  # Save the image URL
-        item_description=item_description,
-        uuid=uuid,
-        registered_date=registered_date_str,
-        status="0"
-    )
-
-    if not await save_item_registration(item):
-        raise HTTPException(status_code=500, detail="Failed to save item registration")
+    image_url = None
+    writes_started = False
+    try:
+        if not owner_exists:
+            raise HTTPException(status_code=404, detail="User not found")
 
-    if not await update_user_items(uuid, item):
-        raise HTTPException(status_code=500, detail="Failed to update user's items")
+        # Upload image to Firebase
+        image_url, image_variants = await upload_service.receive_image(item_image, item_image_upload,
+                                                                       "item_images")
+
+        now = datetime.now()
+        date_string = now.strftime("%Y-%m-%d")
+        registered_date_obj = datetime.strptime(date_string, "%Y-%m-%d").date()
+        registered_date_str = registered_date_obj.strftime("%Y-%m-%d")
+
+        # Save item registration
+        item = ItemRegistration(
+            item_id=item_id,
+            item_type=item_type,
+            item_name=item_name,
+            tag_id=tag_id,
+            item_image=image_url,  # Save the image URL
+            item_image_variants=image_variants,
+            item_description=item_description,
+            uuid=uuid,
+            registered_date=registered_date_str,
+            status="0"
+        )
 
-    if not await update_tag(tag_id, uuid):
-        raise HTTPException(status_code=500, detail="Failed to update the tag")
+        # The two writes don't depend on each other
+        writes_started = True
+        saved, linked = await asyncio.gather(save_item_registration(item), update_user_items(uuid, item))
+        if not (saved and linked):
+            raise HTTPException(status_code=500, detail="Failed to save item registration")
+    except BaseException:
+        # Either write may have landed before the other failed or was cancelled
+        if writes_started:
+            await crud.remove_item_registration(tag_id, uuid)
+        # Give the tag back so the owner can retry
+        await crud.release_tag(tag_id, uuid, claimed.get("uuid"))
+        if image_url:
+            await upload_service.release(image_url)
+        raise
 
     return {"message": "Item registered successfully"}
 
@@ -256,7 +364,7 @@ async def forgot_password(request: schemas.ForgotPasswordRequest):
         token = await crud.create_reset_token(request.email_address.lower())
         if token:
             reset_link = f"https://lfreturnme.com/reset-password/{token}"
-            crud.send_email_reset(request.email_address, reset_link)
+            await crud.send_email_reset(request.email_address, reset_link)
             return {"message": "Password reset email sent"}
         else:
             raise HTTPException(status_code=404, detail="Email address not found")
@@ -264,7 +372,7 @@ async def forgot_password(request: schemas.ForgotPasswordRequest):
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
-@app.post("/reset-password/")
+@app.post("/reset-password/", dependencies=[Depends(reset_password_limit)])
 async def reset_password(request: schemas.ResetPasswordRequest):
     try:
         email_address = await crud.validate_reset_token(request.token)
@@ -277,6 +385,8 @@ async def reset_password(request: schemas.ResetPasswordRequest):
                 raise HTTPException(status_code=500, detail="Failed to reset password")
         else:
             raise HTTPException(status_code=400, detail="Invalid or expired token")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal server error")
 
@@ -286,73 +396,63 @@ async def reset_password(request: schemas.ResetPasswordRequest):
 
 @app.put("/update-item-status/")
 async def update_item_status(
-        background_tasks: BackgroundTasks,
         uuid: str = Query(..., title="UUID of the user"),
         tagid: str = Query(..., title="Tag ID / Item ID to find"),
         new_status: str = Query(..., title="New status (integer) to update")
 ):
-    if new_status == "1":
-        user = await crud.find_user_by_uuid(uuid)
-        item = await crud.find_item_by_tag_id(tagid)
-        background_tasks.add_task(
-            send_email,
+    check_tag_id(tagid)
+    item, user, previous_status = await crud.transition_item_status(tagid, new_status, uuid)
+
+    # A repeat of a request that already landed finds the status unchanged and sends
+    # nothing; the key names this transition, so each real lost report gets its email
+    if new_status == "1" and previous_status != new_status:
+        await outbox.enqueue_email(
             user["email_address"],
             f"Your {item.item_name} is Now Reported as Lost",
-            f"""
-                <h2>Dear {user['full_name']},</h2>
-
-                <p>We’re sorry to hear that you’ve misplaced your <strong>{item.item_description}</strong>. Rest assured, LFReturnMe is here to help you in your efforts to recover it!</p>
-
-                <p>Your item has now been marked as lost in our system, and we will notify members of our Finders Community to be on the lookout.</p>
-
-                <h3>Next Steps:</h3>
-                <ul>
-                    <li><strong>Track Updates:</strong> We’ll keep you informed if any updates or reports come in regarding your lost item.</li>
-                    <li><strong>Spread the Word:</strong> You can also share your lost item details with your network, and encourage others to join our Finders Community to increase your chances of recovery.</li>
-                    <li><strong>Recovery Process:</strong> If your item is found, we’ll notify you immediately with instructions on how to claim it.</li>
-                </ul>
-
-                <p>If you have any questions or need further assistance, feel free to reach out to our support team. We’re with you every step of the way!</p>
-            """
+            email_templates.render("item_lost.html", full_name=user["full_name"],
+                                   item_description=item.item_description),
+            f"status:{tagid}:{previous_status}:{new_status}:{item.status_changed_at.isoformat()}"
         )
 
-    return await crud.update_item_status_full(uuid, tagid, new_status, crud.users_collection, crud.items_collection)
+    return {"message": "Item status updated successfully", "item_tagid": tagid, "new_status": new_status}
 
 
 @app.post("/subscribe")
 async def subscribe_email(subscription: schemas.NewsletterEmail):
-    headers = {
-        "accept": "application/json",
-        "api-key": crud.brevo_api,
-        "content-type": "application/json"
-    }
+    # Stored locally in one round trip; newsletter_sync imports new contacts to Brevo in batches
+    await crud.add_newsletter_email(subscription.email)
 
-    # The payload to be sent to Brevo's API
-    payload = {
-        "email": subscription.email,
-        "listIds": [5],  # Replace with your Brevo List ID
-        "updateEnabled": True  # This will update the contact if it already exists
-    }
+    return {"message": "Email successfully subscribed!"}
 
-    try:
-        # Sending request to Brevo API to add the contact
-        response = requests.post("https://api.brevo.com/v3/contacts", json=payload, headers=headers)
-        response.raise_for_status()  # Raise an error if the request failed
-        await crud.add_newsletter_email(subscription.email)
 
-        return {"message": "Email successfully subscribed!"}
+lf_email = "info@lfreturnme.com"
 
-    except requests.exceptions.RequestException as e:
-        # Handle any errors during the API call
-        raise HTTPException(status_code=400, detail=f"Error subscribing email: {str(e)}")
 
+def team_notice(text: str) -> str:
+    return email_templates.render("team_notice.html", text=text)
 
-lf_email = "info@lfreturnme.com"
+
+async def receive_report_image(item_image: Optional[UploadFile], item_image_upload: Optional[str],
+                               folder_name: str, tag_id: Optional[str], new_status: str):
+    # For tagged reports the item's status changes while the image uploads, so an
+    # unknown tag fails fast and the upload is released instead of kept. Callers
+    # insert the report only after this returns, so a 404 leaves no report behind.
+    if tag_id is not None:
+        check_tag_id(tag_id)
+    upload = asyncio.create_task(upload_service.receive_image(item_image, item_image_upload, folder_name))
+    transition = None
+    try:
+        if tag_id is not None:
+            transition = await crud.transition_item_status(tag_id, new_status)
+    except BaseException:
+        upload_service.discard(upload)
+        raise
+    image_url, image_variants = await upload
+    return image_url, image_variants, transition
 
 
 @app.post("/lost/")
 async def add_lost_item(
-        background_tasks: BackgroundTasks,
         item: str = Form(...),
         name: str = Form(...),
         location: str = Form(...),
@@ -362,11 +462,11 @@ async def add_lost_item(
         item_image: UploadFile = File(None),  # Make item_image optional,
         tag_id: Optional[str] = Form(None),
         specific_location: Optional[str] = Form(None),
+        item_image_upload: Optional[str] = Form(None),
 ):
     start_time = time.time()
-    image_url = ""
-    if item_image is not None:
-        image_url = upload_to_firebase(item_image, "lost_items")
+    image_url, image_variants, transition = await receive_report_image(item_image, item_image_upload, "lost_items",
+                                                                       tag_id, "1")
 
     logging.info(f"Time taken for file upload: {time.time() - start_time} seconds")
 
@@ -385,66 +485,43 @@ async def add_lost_item(
         email=email,
         description=description,
         item_image=image_url,
+        item_image_variants=image_variants,
         tag_id=tag_id,  # Assuming tag_id is part of the form or set to None
         specific_location=specific_location
     )
 
     if lost.tag_id is None:
         # Add to lost collection
-        await crud.add_to_lost(lost)
+        report_id = await crud.add_to_lost(lost)
         # send mail to the person that lost it
         logging.info(f"Time taken for adding to lost collection: {time.time() - start_time} seconds")
 
-        body = f"""
-                       <h2>Dear {lost.name},</h2>
-
-                       <p>Thank you for trusting LFReturnMe to help you recover your lost <strong>{lost.description}</strong>. Our Finders Community is now on alert, and we will do our best to assist you in locating your item.</p>
-
-                       <h3>Here’s what happens next:</h3>
-                       <ul>
-                           <li><strong>Item Registration:</strong> Your lost item has been added to our system, and we’re actively monitoring for any reports from our Finders Community.</li>
-                           <li><strong>Notifications:</strong> If someone reports finding an item matching your description, you will be notified immediately with further instructions.</li>
-                           <li><strong>Spread the Word:</strong> You can increase your chances by sharing the details of your lost item with your friends, family, or social media. We’re also working on expanding our Finders Network to help connect people faster.</li>
-                       </ul>
-
-                       <p><strong>Need extra help?</strong> If you’d like to benefit from additional recovery services, feel free to explore our subscription plans <a href="www.lfreturnme.com">here</a>, which offer enhanced recovery support, priority notifications, and more.</p>
-
-                       <p>For any questions or assistance, don’t hesitate to contact us at [support email or phone number].</p>
-                   """
-        background_tasks.add_task(send_email, lost.email, "We've Received Your Lost Item Report", body)
-
-        # Send email to lfreturme
-        background_tasks.add_task(send_email, lf_email, "reported  Lost item",
-                                  f"item {lost.item} has been reported lost at {lost.location}, this item is not registered and the person that lost is {lost.name}")
+        await outbox.enqueue_emails([
+            outbox.email_message(lost.email, "We've Received Your Lost Item Report",
+                                 email_templates.render("lost_report.html", name=lost.name, description=lost.description),
+                                 f"lost:{report_id}:reporter"),
+            # Send email to lfreturme
+            outbox.email_message(lf_email, "reported  Lost item",
+                                 team_notice(f"item {lost.item} has been reported lost at {lost.location}, this item is not registered and the person that lost is {lost.name}"),
+                                 f"lost:{report_id}:team"),
+        ])
 
         return JSONResponse(status_code=200, content={"message": "Item added to lostfound and email sent"})
     else:
-        # Search items collection by tag_id
-        item = await crud.find_item_by_tag_id(lost.tag_id)
-        if item is None:
-            raise HTTPException(status_code=404, detail="Item not found")
-
-        # Retrieve user information by uuid
-        user = await crud.find_user_by_uuid(item.uuid)
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Update item status to lost using the update tag endpoint
-
-        await crud.update_item_status_full(item.uuid, lost.tag_id, "1", crud.users_collection,
-                                           crud.items_collection)
-        await crud.add_to_lost(lost)
+        # The item was marked lost alongside the upload
+        item, user, _ = transition
+        report_id = await crud.add_to_lost(lost)
         # Send email to user
 
-        background_tasks.add_task(send_email, lf_email, "Item Lost",
-                                  f" registered item '{item.item_name}' has been reported lost.tit is registered")
+        await outbox.enqueue_email(lf_email, "Item Lost",
+                                   team_notice(f" registered item '{item.item_name}' has been reported lost.tit is registered"),
+                                   f"lost:{report_id}:team")
 
         return JSONResponse(status_code=200, content={"message": "Item status updated and email sent to user"})
 
 
 @app.post("/found/")
 async def add_found_item(
-        background_tasks: BackgroundTasks,
         item: str = Form(...),
         name: str = Form(...),
         location: str = Form(...),
@@ -454,13 +531,12 @@ async def add_found_item(
         item_image: UploadFile = File(None),
         tag_id: Optional[str] = Form(None),
         specific_location: Optional[str] = Form(None),
+        item_image_upload: Optional[str] = Form(None),
 ):
     print(specific_location)
     start_time = time.time()
-    if item_image is not None:
-        image_url = upload_to_firebase(item_image, "found_items")
-    else:
-        image_url = ""
+    image_url, image_variants, transition = await receive_report_image(item_image, item_image_upload, "found_items",
+                                                                       tag_id, "2")
     now = datetime.now()
     date_string = now.strftime("%Y-%m-%d")
     registered_date_obj = datetime.strptime(date_string, "%Y-%m-%d").date()
@@ -476,102 +552,79 @@ async def add_found_item(
         email=email,
         description=description,
         item_image=image_url,
+        item_image_variants=image_variants,
         tag_id=tag_id,  # Assuming tag_id is part of the form or set to None
         specific_location=specific_location,
     )
 
     if found.tag_id is None:
         # Add to found collection
-        await crud.add_to_found(found)
-
-        # Send thank-you email to the person who found the item
-        background_tasks.add_task(
-            send_email,
-            found.email,
-            "Thank You for Reporting a Found Item on LFReturnMe",
-            f"""
-            <h2>Thank You for Reporting a Found Item!</h2>
-            <p>Dear {found.name},</p>
-            <p>We are thrilled to receive your report about the <strong>{found.description}</strong> you found! Thank you for playing an 
-            important role in reconnecting lost items with their rightful owners. Your contribution makes a real difference.</p>
-            <p>Our team is actively working on matching the found item with its owner. We’ll keep you updated on the next steps.</p>
-            <h3>What happens next:</h3>
-            <ul>
-                <li>If the owner of the item claims it, we’ll facilitate the recovery process through our platform.</li>
-                <li>Should the owner wish to express their gratitude, there may be a small token of appreciation sent your way.</li>
-            </ul>
-            <p>In the meantime, thank you for being an amazing part of our Finders Community! If you have any questions or concerns, feel free to contact us.</p>
-            """
-        )
-
-        # Send email to LFReturnMe team
-        background_tasks.add_task(
-            send_email,
-            lf_email,
-            "Item found with a tag",
-            f"""Item {found.item} has been found at {found.location}. 
+        report_id = await crud.add_to_found(found)
+
+        await outbox.enqueue_emails([
+            # Send thank-you email to the person who found the item
+            outbox.email_message(
+                found.email,
+                "Thank You for Reporting a Found Item on LFReturnMe",
+                email_templates.render("found_thanks.html", name=found.name, description=found.description),
+                f"found:{report_id}:finder"
+            ),
+            # Send email to LFReturnMe team
+            outbox.email_message(
+                lf_email,
+                "Item found with a tag",
+                team_notice(f"""Item {found.item} has been found at {found.location}. 
             The item is a {found.description}, reported by {found.name}. 
-            The finder's contacts are {found.phone_number} and {found.email}."""
-        )
+            The finder's contacts are {found.phone_number} and {found.email}."""),
+                f"found:{report_id}:team"
+            ),
+        ])
 
         return JSONResponse(status_code=200, content={"message": "Item added to found and email sent"})
 
     else:
-        # Search items collection by tag_id
-        item = await crud.find_item_by_tag_id(found.tag_id)
-        if item is None:
-            raise HTTPException(status_code=404, detail="Item not found")
-
-        # Retrieve user information by uuid
-        user = await crud.find_user_by_uuid(item.uuid)
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Update item status to lost using the update tag endpoint
-        await crud.update_item_status_full(item.uuid, found.tag_id, "2", crud.users_collection, crud.items_collection)
-        await crud.add_to_found(found)
-
-        # Send email to LFReturnMe team
-        background_tasks.add_task(
-            send_email,
-            lf_email,
-            "Item found with a tag",
-            f"""Item {found.item} has been found at {found.location}. 
+        # The item was marked found alongside the upload
+        item, user, _ = transition
+        report_id = await crud.add_to_found(found)
+
+        # Both messages go into the outbox in one write and leave in the same Brevo batch
+        await outbox.enqueue_emails([
+            # Send email to LFReturnMe team
+            outbox.email_message(
+                lf_email,
+                "Item found with a tag",
+                team_notice(f"""Item {found.item} has been found at {found.location}. 
             The item is a {found.description}, the tag ID is {found.tag_id}, reported by {found.name}. 
-            The finder's contacts are {found.phone_number} and {found.email}."""
-        )
-
-        # Send thank-you email to the finder
-        background_tasks.add_task(
-            send_email,
-            found.email,
-            "Thank You for Reporting a Found Item on LFReturnMe",
-            f"""
-            <h2>Thank You for Reporting a Found Item!</h2>
-            <p>Dear {found.name},</p>
-            <p>We are thrilled to receive your report about the <strong>{found.description}</strong> you found! Thank you for playing an 
-            important role in reconnecting lost items with their rightful owners. Your contribution makes a real difference.</p>
-            <p>Our team is actively working on matching the found item with its owner. We’ll keep you updated on the next steps.</p>
-            <h3>What happens next:</h3>
-            <ul>
-                <li>If the owner of the item claims it, we’ll facilitate the recovery process through our platform.</li>
-                <li>Should the owner wish to express their gratitude, there may be a small token of appreciation sent your way.</li>
-            </ul>
-            <p>In the meantime, thank you for being an amazing part of our Finders Community! If you have any questions or concerns, feel free to contact us.</p>
-            """
-        )
+            The finder's contacts are {found.phone_number} and {found.email}."""),
+                f"found:{report_id}:team"
+            ),
+            # Send thank-you email to the finder
+            outbox.email_message(
+                found.email,
+                "Thank You for Reporting a Found Item on LFReturnMe",
+                email_templates.render("found_thanks.html", name=found.name, description=found.description),
+                f"found:{report_id}:finder"
+            ),
+        ])
 
         return JSONResponse(status_code=200,
                             content={"message": "Item status updated and emails sent to user and finder"})
 
 
+async def release_new_picture(picture_url: Optional[str], current_picture_url: Optional[str]):
+    # A picture taken for a profile update that didn't go through
+    if picture_url and picture_url != current_picture_url:
+        await upload_service.release(picture_url)
+
+
 @app.put("/update-profile/")
 async def update_profile(
         user_uuid: str = Form(...),
         full_name: str = Form(...),
         email_address: str = Form(...),
         address: str = Form(...),
-        profile_picture: UploadFile = File(None)
+        profile_picture: UploadFile = File(None),
+        profile_picture_upload: Optional[str] = Form(None),
 ):
     # Retrieve the current user profile from MongoDB
     user = await crud.get_user_by_uuid(user_uuid)
@@ -583,33 +636,44 @@ async def update_profile(
     email_address = email_address.lower()
 
     # Handle the profile picture upload if provided
-    profile_picture_url = upload_to_firebase(profile_picture,
-                                             "profile_picture") if profile_picture else current_picture_url
+    profile_picture_url = current_picture_url
+    update_data = {}
+    if profile_picture or profile_picture_upload:
+        profile_picture_url, update_data["profile_picture_variants"] = await upload_service.receive_image(
+            profile_picture, profile_picture_upload, "profile_picture")
 
     # Create the update data dictionary
-    update_data = {
+    update_data.update({
         "full_name": full_name,
         "email_address": email_address,
         "address": address,
         "profile_picture": profile_picture_url
-    }
+    })
 
     # Perform the update operation
-    result = await crud.update_user_profile(user_uuid, update_data)
+    try:
+        result = await crud.update_user_profile(user_uuid, update_data)
+    except DuplicateKeyError:
+        # The new email belongs to another account
+        await release_new_picture(profile_picture_url, current_picture_url)
+        raise HTTPException(status_code=400, detail="Email address already in use")
 
-    if current_picture_url:
-        crud.delete_from_firebase(current_picture_url)
     # Check if the update was successful
     if result.matched_count == 0:
+        await release_new_picture(profile_picture_url, current_picture_url)
         raise HTTPException(status_code=404, detail="User not found")
 
+    # Only a replaced picture is released; the sweeper deletes it later if nothing uses it
+    if current_picture_url and profile_picture_url != current_picture_url:
+        await upload_service.release(current_picture_url)
+
     return {"message": "User profile updated successfully"}
 
 
 @app.post("/api/send-otp")
 async def send_otp(request: schemas.OTPRequest):
     otp = crud.generate_otp()
-    crud.send_email_otp(request.email, otp)
+    await crud.send_email_otp(request.email, otp)
 
     otp_data = {
         "email": request.email,
@@ -655,7 +719,8 @@ async def get_user_dashboard(uuid: str):
         raise HTTPException(status_code=404, detail="User not found")
 
     # Call the function to generate or retrieve the access token
-    access_token = await crud.save_access_code(uuid)
+    access_token = await crud.get_access_code(uuid)
+    user = crud.with_served_image(user, "profile_picture")
 
     # Convert MongoDB user document to ResponseSignup model
     user_data = schemas.ResponseSignup(
@@ -666,13 +731,14 @@ async def get_user_dashboard(uuid: str):
         address=user.get("address"),
         # id_no=user.get("id_no"),
         profile_picture=user.get("profile_picture"),
+        profile_picture_variants=user.get("profile_picture_variants"),
         phone_number=user.get("phone_number"),
         gender=user.get("gender"),
         # valid_id_type=user.get("valid_id_type"),
         # id_card_image=user.get("id_card_image"),
         password=user.get("password"),
         is_verified=user.get("is_verified"),
-        items=user.get("items", {})  # Assuming items are stored as a dictionary
+        items=crud.with_served_images(crud.with_subscription_states(user.get("items", {})))  # Assuming items are stored as a dictionary
     )
 
     # Add the access token to the response data
@@ -722,23 +788,20 @@ async def paystack_webhook(request: Request, background_tasks: BackgroundTasks):
 
 @app.get("/items/", response_model=List[LostFound])
 async def get_items_by_location(
+        response: Response,
         location: str = Query(..., description="Location to filter items by, e.g., 'Abuja'"),
-        page: int = Query(1, ge=1, description="Page number"),
-        page_size: int = Query(10, ge=1, le=100, description="Number of items per page")
+        page: int = Query(1, ge=1, description="Page number (prefer cursor)"),
+        page_size: int = Query(10, ge=1, le=100, description="Number of items per page"),
+        cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
 ):
-    # Calculate the number of items to skip based on the page number and page size
-    skip = (page - 1) * page_size
-
-    # Fetch items based on the location filter, sorted by `date` in descending order, with pagination
-    items_cursor = crud.found_collection.find(
-        {"location": location}
-    ).sort("date", -1).skip(skip).limit(page_size)
-
-    # Convert the cursor to a list asynchronously
-    items = await items_cursor.to_list(length=page_size)
+    # A cursor resumes after the previous page at constant cost; page is still
+    # honoured (by skipping) for older clients
+    items, next_cursor = await crud.find_items_page(location, page_size, cursor, skip=(page - 1) * page_size)
 
     # Check if the items list is empty and return a 404 error if no items are found
     if not items:
         raise HTTPException(status_code=404, detail="No items found for the given location")
 
-    return items
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [crud.with_served_image(item, "item_image") for item in items]
@@ -0,0 +1,53 @@
+import logging
+import os
+
+from crud import newsletters_collection
+from jobs import PeriodicLeasedTask
+from mailer import email_transport
+
+logger = logging.getLogger(__name__)
+
+NEWSLETTER_LIST_ID = int(os.getenv("BREVO_NEWSLETTER_LIST_ID", 5))
+NEWSLETTER_BATCH_SIZE = int(os.getenv("NEWSLETTER_BATCH_SIZE", 1000))
+NEWSLETTER_FLUSH_SECONDS = float(os.getenv("NEWSLETTER_FLUSH_SECONDS", 30))
+
+
+class NewsletterSync(PeriodicLeasedTask):
+    # Pushes locally stored subscriptions to Brevo with the bulk contact import,
+    # one call per batch instead of one per signup. Only the worker holding the
+    # lease flushes, so a batch is never imported twice at the same time; unsynced
+    # rows stay flagged until a flush gets them out.
+
+    def __init__(self, batch_size: int, interval: float):
+        super().__init__("newsletter_sync", interval, self.flush)
+        self.batch_size = batch_size
+
+    async def flush_batch(self) -> int:
+        pending = await newsletters_collection.find({"synced": False}, {"email": 1}) \
+            .sort("created_at", 1).limit(self.batch_size).to_list(length=self.batch_size)
+        if not pending:
+            return 0
+
+        await email_transport.post("/contacts/import", {
+            "listIds": [NEWSLETTER_LIST_ID],
+            "jsonBody": [{"email": doc["email"]} for doc in pending],
+            "updateExistingContacts": True,
+            "emptyContactsAttributes": False,
+        })
+        await newsletters_collection.update_many(
+            {"_id": {"$in": [doc["_id"] for doc in pending]}},
+            {"$set": {"synced": True}}
+        )
+        logger.info("Imported %d newsletter contacts to Brevo", len(pending))
+        return len(pending)
+
+    async def flush(self) -> int:
+        total = 0
+        while True:
+            count = await self.flush_batch()
+            total += count
+            if count < self.batch_size:
+                return total
+
+
+newsletter_sync = NewsletterSync(NEWSLETTER_BATCH_SIZE, NEWSLETTER_FLUSH_SECONDS)
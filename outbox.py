@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import httpx
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from crud import db
+from jobs import BackgroundTask
+from mailer import email_transport
+
+logger = logging.getLogger(__name__)
+
+outbox_collection = db["email_outbox"]
+
+SENDER = {"name": "LFReturnMe Team", "email": "no_reply@lfreturnme.com"}
+
+OUTBOX_BATCH_SIZE = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", 100))
+OUTBOX_POLL_SECONDS = float(os.getenv("EMAIL_OUTBOX_POLL_SECONDS", 2))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("EMAIL_OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_CLAIM_TTL = timedelta(minutes=2)
+OUTBOX_RETENTION = timedelta(days=7)
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 3600
+
+
+def email_message(to_email: str, subject: str, html: str, idempotency_key: Optional[str] = None) -> dict:
+    # A message is durable once inserted; the key makes retried enqueues no-ops
+    now = datetime.utcnow()
+    return {
+        "idempotency_key": idempotency_key or str(uuid.uuid4()),
+        "to": to_email,
+        "subject": subject,
+        "html": html,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+    }
+
+
+async def ensure_indexes():
+    await outbox_collection.create_index("idempotency_key", unique=True)
+    await outbox_collection.create_index([("status", ASCENDING), ("next_attempt_at", ASCENDING)])
+    await outbox_collection.create_index("sent_at", expireAfterSeconds=int(OUTBOX_RETENTION.total_seconds()))
+
+
+async def enqueue_emails(messages: List[dict]) -> int:
+    # One insert round trip for all messages of a request; duplicates are skipped
+    if not messages:
+        return 0
+    try:
+        result = await outbox_collection.insert_many(messages, ordered=False)
+        inserted = len(result.inserted_ids)
+    except BulkWriteError as e:
+        duplicates = [err for err in e.details.get("writeErrors", []) if err.get("code") == 11000]
+        if len(duplicates) != len(e.details.get("writeErrors", [])):
+            raise
+        inserted = e.details.get("nInserted", 0)
+        logger.info("Skipped %d duplicate outbox messages", len(duplicates))
+
+    outbox_worker.wake()
+    return inserted
+
+
+async def enqueue_email(to_email: str, subject: str, html: str, idempotency_key: Optional[str] = None) -> bool:
+    try:
+        await outbox_collection.insert_one(email_message(to_email, subject, html, idempotency_key))
+    except DuplicateKeyError:
+        logger.info("Email %s already queued", idempotency_key)
+        return False
+
+    outbox_worker.wake()
+    return True
+
+
+def _backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS))
+
+
+def batch_payload(messages: List[dict]) -> dict:
+    # Brevo sends one email per messageVersion, so the whole batch is a single API call.
+    # The base subject/htmlContent are required and each version overrides them.
+    return {
+        "sender": SENDER,
+        "subject": messages[0]["subject"],
+        "htmlContent": messages[0]["html"],
+        "messageVersions": [
+            {"to": [{"email": message["to"]}], "subject": message["subject"], "htmlContent": message["html"]}
+            for message in messages
+        ],
+    }
+
+
+class OutboxWorker(BackgroundTask):
+    # Claims due messages in batches and sends each batch with one Brevo request.
+    # Claims are leased, so messages held by a crashed worker are picked up again.
+
+    def __init__(self, batch_size: int, poll_seconds: float):
+        super().__init__()
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.worker_id = uuid.uuid4().hex
+        self._wakeup = asyncio.Event()
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def claim_batch(self) -> List[dict]:
+        now = datetime.utcnow()
+        due = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "claimed_until": {"$lte": now}},
+        ]}
+        candidates = await outbox_collection.find(due, {"_id": 1}).sort("next_attempt_at", ASCENDING) \
+            .limit(self.batch_size).to_list(length=self.batch_size)
+        if not candidates:
+            return []
+
+        claim_id = f"{self.worker_id}:{uuid.uuid4().hex}"
+        await outbox_collection.update_many(
+            {"_id": {"$in": [doc["_id"] for doc in candidates]}, **due},
+            {"$set": {"status": "sending", "claim_id": claim_id, "claimed_until": now + OUTBOX_CLAIM_TTL}}
+        )
+        return await outbox_collection.find({"claim_id": claim_id}).to_list(length=self.batch_size)
+
+    async def send_batch(self, messages: List[dict]):
+        ids = [message["_id"] for message in messages]
+        try:
+            await email_transport.send(batch_payload(messages))
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 400 and len(messages) > 1:
+                # One bad address rejects the whole batch, so isolate it
+                for message in messages:
+                    await self.send_batch([message])
+                return
+            await self._reschedule(messages, e)
+            return
+        except Exception as e:
+            await self._reschedule(messages, e)
+            return
+
+        await outbox_collection.update_many(
+            {"_id": {"$in": ids}, "claim_id": messages[0]["claim_id"]},
+            {"$set": {"status": "sent", "sent_at": datetime.utcnow()},
+             "$inc": {"attempts": 1},
+             "$unset": {"claim_id": "", "claimed_until": ""}}
+        )
+        logger.info("Outbox sent %d emails", len(messages))
+
+    async def _reschedule(self, messages: List[dict], e: Exception):
+        logger.error("Outbox batch of %d failed: %s", len(messages), e)
+        now = datetime.utcnow()
+        for message in messages:
+            attempts = message["attempts"] + 1
+            failed = attempts >= OUTBOX_MAX_ATTEMPTS
+            await outbox_collection.update_one(
+                {"_id": message["_id"], "claim_id": message["claim_id"]},
+                {"$set": {"status": "failed" if failed else "pending", "attempts": attempts,
+                          "next_attempt_at": now + _backoff(attempts), "last_error": str(e)},
+                 "$unset": {"claim_id": "", "claimed_until": ""}}
+            )
+
+    async def run(self):
+        while True:
+            try:
+                messages = await self.claim_batch()
+                if messages:
+                    await self.send_batch(messages)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Outbox worker error: %s", e)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+
+outbox_worker = OutboxWorker(OUTBOX_BATCH_SIZE, OUTBOX_POLL_SECONDS)
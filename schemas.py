@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field, EmailStr
 from datetime import date, datetime
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 from bson import ObjectId
 
 
@@ -34,6 +34,9 @@ class ItemRegistration(BaseModel):
     tier: Optional[str] = None
     subscription_code: Optional[str] = None
     subscription_end: Optional[int] = None
+    expires_at: Optional[datetime] = None
+    item_image_variants: Optional[Dict[str, str]] = None
+    status_changed_at: Optional[datetime] = None
 
 
 class Signup(BaseModel):
@@ -43,6 +46,7 @@ class Signup(BaseModel):
     date_of_birth: date
     address: str
     profile_picture: str
+    profile_picture_variants: Optional[Dict[str, str]] = None
     phone_number: str
     gender: str
     password: str
@@ -68,6 +72,17 @@ class Tag(BaseModel):
         json_encoders = {ObjectId: str}
 
 
+class TagImportRow(BaseModel):
+    # One provisioned tag from a manufacturing batch; new tags start unowned
+    id: int
+    tag1: str = Field(..., min_length=1)
+    tagid: str
+    tag_name: str
+    date: str = Field(default_factory=lambda: date.today().isoformat())
+    uuid: str = ""
+    is_owned: bool = False
+
+
 class ResponseSignup(BaseModel):
     uuid: Optional[str] = None
     full_name: Optional[str] = None
@@ -76,6 +91,7 @@ class ResponseSignup(BaseModel):
     address: Optional[str] = None
     #id_no: Optional[str] = None
     profile_picture: Optional[str] = None
+    profile_picture_variants: Optional[Dict[str, str]] = None
     phone_number: Optional[str] = None
     gender: Optional[str] = None
     #valid_id_type: Optional[str] = None
@@ -134,12 +150,38 @@ class LostFound(BaseModel):
     email: EmailStr
     description: str
     item_image: str
+    item_image_variants: Optional[Dict[str, str]] = None
+
+
+class TagLookupRequest(BaseModel):
+    tag_ids: List[str] = Field(..., min_length=1, max_length=500)
+
+
+class TagLookupResult(BaseModel):
+    tag_id: str
+    registered: bool
+    item_name: Optional[str] = None
+    item_type: Optional[str] = None
+    status: Optional[str] = None
+    notify_owner: bool = False
 
 
 class UpdateProfileRequest(BaseModel):
     profile_picture: str
 
 
+class SignedUploadRequest(BaseModel):
+    purpose: str = Field(..., description="profile_picture, item_image, lost_item or found_item")
+    content_type: str
+
+
+class SignedUpload(BaseModel):
+    upload_url: str
+    object_name: str
+    headers: Dict[str, str]
+    expires_at: datetime
+
+
 # Model to receive email data
 class OTPRequest(BaseModel):
     email: EmailStr
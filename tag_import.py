@@ -0,0 +1,194 @@
+"""Bulk tag provisioning from CSV or NDJSON.
+
+Rows are validated with a compiled TypeAdapter and written in unordered batches;
+the unique index on tags.tag1 turns repeats into reported duplicates. Memory use
+is bounded by the batch size, not the file size. Quoted CSV fields may span
+lines; a record is parsed once its quotes are balanced.
+
+Run with `python tag_import.py tags.csv [--format csv|ndjson] [--batch-size N]`,
+or POST the file body to /admin/tags/import.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator, List, Optional
+
+from pydantic import TypeAdapter, ValidationError
+from pymongo.errors import BulkWriteError
+
+from crud import ensure_indexes, tags_collection
+from schemas import TagImportRow
+
+logger = logging.getLogger(__name__)
+
+TAG_IMPORT_BATCH_SIZE = int(os.getenv("TAG_IMPORT_BATCH_SIZE", 1000))
+# Cap on how many duplicate codes and row errors are echoed back in a report
+REPORT_SAMPLE_SIZE = 100
+
+tag_row_adapter = TypeAdapter(TagImportRow)
+
+
+async def lines_from_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # Splits a byte stream (e.g. a request body) into lines without buffering it whole;
+    # line endings are kept, as when reading a file
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8-sig") + "\n"
+    if pending:
+        yield pending.decode("utf-8-sig")
+
+
+async def lines_from_file(path: str) -> AsyncIterator[str]:
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for line in f:
+            yield line
+
+
+class ImportReport:
+    # Running totals plus a sample of what was skipped and why
+
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.duplicate_tags: List[str] = []
+        self.errors: List[dict] = []
+        self.started = time.monotonic()
+
+    def error(self, line: int, message: str):
+        self.invalid += 1
+        if len(self.errors) < REPORT_SAMPLE_SIZE:
+            self.errors.append({"line": line, "error": message})
+
+    def as_dict(self) -> dict:
+        seconds = time.monotonic() - self.started
+        return {
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+            "duplicate_tags": self.duplicate_tags,
+            "errors": self.errors,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.rows / seconds, 1) if seconds else None,
+        }
+
+
+async def _insert_batch(docs: List[dict], report: ImportReport, on_inserted=None):
+    try:
+        result = await tags_collection.insert_many(docs, ordered=False)
+        report.inserted += len(result.inserted_ids)
+    except BulkWriteError as e:
+        report.inserted += e.details.get("nInserted", 0)
+        for err in e.details.get("writeErrors", []):
+            if err.get("code") != 11000:
+                raise
+            report.duplicates += 1
+            if len(report.duplicate_tags) < REPORT_SAMPLE_SIZE:
+                report.duplicate_tags.append(err["op"]["tag1"])
+    if on_inserted is not None:
+        # Existing duplicates are provisioned too, so passing every code is harmless
+        for doc in docs:
+            on_inserted(doc["tag1"])
+
+
+def _parse_row(line: str, fmt: str, header: Optional[List[str]]) -> dict:
+    if fmt == "ndjson":
+        return json.loads(line)
+    # Empty cells fall back to the model defaults
+    values = next(csv.reader([line]))
+    return {key: value.strip() for key, value in zip(header, values) if value.strip()}
+
+
+def _describe(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+    return str(e)
+
+
+async def import_tags(lines: AsyncIterator[str], fmt: str = "csv", batch_size: int = TAG_IMPORT_BATCH_SIZE,
+                      on_inserted=None) -> dict:
+    # One batch is validated while the previous one is being written
+    report = ImportReport()
+    header: Optional[List[str]] = None
+    batch: List[dict] = []
+    writing: Optional[asyncio.Task] = None
+    line_number = 0
+    record = ""
+    record_line = 0
+
+    async for line in lines:
+        line_number += 1
+        if fmt == "csv":
+            # An odd number of quotes means a quoted field continues on the next line
+            if not record:
+                record_line = line_number
+            record += line
+            if record.count('"') % 2:
+                continue
+            line, record = record, ""
+        if not line.strip():
+            continue
+        if fmt == "csv" and header is None:
+            header = [name.strip() for name in next(csv.reader([line]))]
+            continue
+
+        report.rows += 1
+        try:
+            batch.append(tag_row_adapter.validate_python(_parse_row(line, fmt, header)).model_dump())
+        except (ValueError, csv.Error) as e:
+            # ValidationError and JSONDecodeError are both ValueErrors
+            report.error(record_line if fmt == "csv" else line_number, _describe(e))
+            continue
+
+        if len(batch) >= batch_size:
+            if writing is not None:
+                await writing
+            writing = asyncio.create_task(_insert_batch(batch, report, on_inserted))
+            batch = []
+
+    if record:
+        report.rows += 1
+        report.error(record_line, "Unterminated quoted field")
+    if writing is not None:
+        await writing
+    if batch:
+        await _insert_batch(batch, report, on_inserted)
+
+    result = report.as_dict()
+    logger.info("Imported %d of %d tags (%d duplicates, %d invalid) at %s rows/s",
+                result["inserted"], result["rows"], result["duplicates"], result["invalid"],
+                result["rows_per_second"])
+    return result
+
+
+async def run_import(path: str, fmt: str, batch_size: int) -> dict:
+    # Outside the app nothing else has created the unique tag1 index yet, and
+    # without it repeats would be inserted instead of reported
+    await ensure_indexes()
+    return await import_tags(lines_from_file(path), fmt, batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import provisioned tags from CSV or NDJSON")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "ndjson"])
+    parser.add_argument("--batch-size", type=int, default=TAG_IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    fmt = args.format or ("ndjson" if args.path.endswith((".ndjson", ".jsonl")) else "csv")
+    report = asyncio.run(run_import(args.path, fmt, args.batch_size))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+from datetime import timedelta
+from typing import Optional
+
+from bson import ObjectId
+from cachetools import TTLCache
+
+from crud import tags_collection
+from jobs import BackgroundTask
+from schemas import Tag
+
+logger = logging.getLogger(__name__)
+
+TAG_CACHE_SIZE = int(os.getenv("TAG_CACHE_SIZE", 10000))
+TAG_CACHE_TTL = int(os.getenv("TAG_CACHE_TTL_SECONDS", 60))
+TAG_NEGATIVE_CACHE_TTL = int(os.getenv("TAG_NEGATIVE_CACHE_TTL_SECONDS", 30))
+TAG_BLOOM_CAPACITY = int(os.getenv("TAG_BLOOM_CAPACITY", 1_000_000))
+TAG_BLOOM_ERROR_RATE = float(os.getenv("TAG_BLOOM_ERROR_RATE", 0.001))
+# How often each worker picks up tags provisioned elsewhere
+TAG_BLOOM_REFRESH_SECONDS = float(os.getenv("TAG_BLOOM_REFRESH_SECONDS", 60))
+# ObjectIds from different clients are only roughly ordered, so each refresh rescans
+# a little before the newest _id it has seen
+TAG_BLOOM_REFRESH_OVERLAP = timedelta(minutes=2)
+
+
+class BloomFilter:
+    # Fixed-size set membership with no false negatives. Positions come from one
+    # blake2b digest split into two halves (Kirsch-Mitzenmacher double hashing).
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class TagResolver(BackgroundTask):
+    # Per-worker tag lookups. Known tags are served from an LRU/TTL cache, recent
+    # misses from a short negative cache, and codes that were never provisioned are
+    # rejected by the Bloom filter without touching Mongo, so guessing tag codes
+    # doesn't turn into database load.
+
+    def __init__(self):
+        super().__init__()
+        self.cache = TTLCache(maxsize=TAG_CACHE_SIZE, ttl=TAG_CACHE_TTL)
+        self.negative_cache = TTLCache(maxsize=TAG_CACHE_SIZE, ttl=TAG_NEGATIVE_CACHE_TTL)
+        self.bloom: Optional[BloomFilter] = None
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.bloom_rejects = 0
+        self._last_id: Optional[ObjectId] = None
+
+    def may_exist(self, tag1: str) -> bool:
+        # False only when the tag is known not to exist; answered without a round trip
+        if tag1 in self.negative_cache:
+            self.negative_hits += 1
+            return False
+        if self.bloom is not None and tag1 not in self.bloom:
+            self.bloom_rejects += 1
+            return False
+        return True
+
+    async def get(self, tag1: str) -> Optional[Tag]:
+        tag = self.cache.get(tag1)
+        if tag is not None:
+            self.hits += 1
+            return tag
+        if not self.may_exist(tag1):
+            return None
+
+        self.misses += 1
+        tag_data = await tags_collection.find_one({"tag1": tag1})
+        if tag_data is None:
+            self.negative_cache[tag1] = True
+            return None
+        tag = Tag(**tag_data)
+        self.cache[tag1] = tag
+        return tag
+
+    def invalidate(self, tag1: str):
+        self.cache.pop(tag1, None)
+
+    def provisioned(self, tag1: str):
+        # Called when this worker creates a tag; other workers see it on their next refresh
+        self.negative_cache.pop(tag1, None)
+        if self.bloom is not None:
+            self.bloom.add(tag1)
+
+    async def _load_since(self, bloom: BloomFilter, last_id: Optional[ObjectId]) -> Optional[ObjectId]:
+        query = {}
+        if last_id is not None:
+            query = {"_id": {"$gt": ObjectId.from_datetime(last_id.generation_time - TAG_BLOOM_REFRESH_OVERLAP)}}
+        async for doc in tags_collection.find(query, {"tag1": 1}).sort("_id", 1).batch_size(10000):
+            if doc["tag1"] not in bloom:
+                bloom.add(doc["tag1"])
+            last_id = max(last_id, doc["_id"]) if last_id is not None else doc["_id"]
+        return last_id
+
+    async def refresh(self):
+        if self.bloom is None or self.bloom.count > self.bloom.capacity:
+            # Full build, sized with headroom so the false positive rate holds as tags are added
+            total = await tags_collection.estimated_document_count()
+            bloom = BloomFilter(max(TAG_BLOOM_CAPACITY, total * 2), TAG_BLOOM_ERROR_RATE)
+            self._last_id = await self._load_since(bloom, None)
+            self.bloom = bloom
+            logger.info("Tag Bloom filter built with %d tags", bloom.count)
+        else:
+            # Tags are only ever inserted, so new ones are those around or past the last _id seen
+            self._last_id = await self._load_since(self.bloom, self._last_id)
+        # A tag negatively cached before it was provisioned must become visible
+        self.negative_cache.clear()
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Until the first build succeeds every lookup falls through to Mongo
+                logger.error("Tag Bloom filter refresh failed: %s", e)
+            await asyncio.sleep(TAG_BLOOM_REFRESH_SECONDS)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "bloom_rejects": self.bloom_rejects,
+            "cached": len(self.cache),
+            "bloom_tags": self.bloom.count if self.bloom is not None else None,
+        }
+
+
+tag_resolver = TagResolver()
@@ -0,0 +1,331 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, UploadFile
+from pymongo import ReturnDocument
+
+import crud
+from blob_gc import BLOB_GC_GRACE, schedule_deletion
+from crud import blobs_collection, db
+from images import IMAGE_CONTENT_TYPE, IMAGE_FORMAT, image_processor
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 8))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 10 * 1024 * 1024))
+UPLOAD_LATENCY_SAMPLES = 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Direct-to-storage uploads: objects handed out with a signed URL and not yet finalized
+signed_uploads_collection = db["signed_uploads"]
+SIGNED_UPLOAD_TTL = timedelta(seconds=int(os.getenv("SIGNED_UPLOAD_TTL_SECONDS", 900)))
+# What a signed upload is for, and the folder it goes in
+UPLOAD_FOLDERS = {
+    "profile_picture": "profile_picture",
+    "item_image": "item_images",
+    "lost_item": "lost_items",
+    "found_item": "found_items",
+}
+SIGNED_UPLOAD_CONTENT_TYPES = {"image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"}
+
+
+async def ensure_indexes():
+    await blobs_collection.create_index("url", sparse=True)
+    await signed_uploads_collection.create_index("expires_at", expireAfterSeconds=0)
+
+
+def file_size(file: UploadFile) -> int:
+    # The body is already spooled (to disk past 1MB), so seek instead of reading it
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+    return size
+
+
+def content_digest(stream) -> str:
+    # Hashes the spooled body a chunk at a time, so memory use doesn't grow with the file
+    stream.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class UploadMetrics:
+    # Rolling latency window plus running totals, split into time spent waiting for
+    # a worker thread and time spent talking to storage
+
+    def __init__(self, samples: int):
+        self.uploads = 0
+        self.failures = 0
+        self.rejected = 0
+        self.deduplicated = 0
+        self.bytes = 0
+        self._queue_wait = deque(maxlen=samples)
+        self._latency = deque(maxlen=samples)
+
+    def record(self, size: int, queue_wait: float, latency: float):
+        self.uploads += 1
+        self.bytes += size
+        self._queue_wait.append(queue_wait)
+        self._latency.append(latency)
+
+    @staticmethod
+    def _percentiles(samples) -> dict:
+        if not samples:
+            return {"p50": None, "p95": None, "p99": None, "max": None}
+        ordered = sorted(samples)
+        pick = lambda q: round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 4)
+        return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1], 4)}
+
+    def snapshot(self) -> dict:
+        return {
+            "uploads": self.uploads,
+            "failures": self.failures,
+            "rejected_too_large": self.rejected,
+            "deduplicated": self.deduplicated,
+            "bytes": self.bytes,
+            "queue_wait_seconds": self._percentiles(self._queue_wait),
+            "upload_seconds": self._percentiles(self._latency),
+        }
+
+
+class UploadService:
+    # Runs Firebase Storage uploads on worker threads, so the event loop never blocks
+    # on the network. Plain uploads stream from the spooled file; photos are first
+    # normalized into small variants by images.image_processor. Uploads are stored
+    # under the SHA-256 of their content and shared by every record that uploads
+    # the same bytes.
+
+    def __init__(self, workers: int, max_bytes: int):
+        self.workers = max(workers, 1)
+        self.max_bytes = max_bytes
+        self.metrics = UploadMetrics(UPLOAD_LATENCY_SAMPLES)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._discarding = set()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upload")
+        return self._executor
+
+    def _timed(self, fn, args: tuple, size: int, queued_at: float):
+        started = time.monotonic()
+        result = fn(*args)
+        self.metrics.record(size, started - queued_at, time.monotonic() - started)
+        return result
+
+    async def _run(self, fn, *args, size: int):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._timed, fn, args, size, time.monotonic())
+
+    def _check_size(self, file: UploadFile) -> int:
+        size = file_size(file)
+        if size > self.max_bytes:
+            self.metrics.rejected += 1
+            raise HTTPException(status_code=413,
+                                detail=f"File too large, the limit is {self.max_bytes // (1024 * 1024)}MB")
+        return size
+
+    async def _digest(self, file: UploadFile) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, content_digest, file.file)
+
+    async def _store(self, key: str, folder_name: str, store) -> Tuple[str, Dict[str, str]]:
+        # Takes a reference on the content. Only the first request for it pays for the
+        # upload; later ones reuse the stored URLs. Blob names are derived from the hash,
+        # so two requests racing on new content just write the same objects.
+        blob = await blobs_collection.find_one_and_update(
+            {"_id": key},
+            {"$inc": {"refs": 1}, "$setOnInsert": {"created_at": datetime.utcnow()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if blob.get("url"):
+            self.metrics.deduplicated += 1
+            return blob["url"], blob.get("variants", {})
+
+        uploaded: List[str] = []
+        try:
+            url, variants = await store(uploaded)
+        except HTTPException:
+            await self._drop_reference(key, uploaded)
+            raise
+        except Exception as e:
+            self.metrics.failures += 1
+            logger.error("Upload to %s failed: %s", folder_name, e)
+            await self._drop_reference(key, uploaded)
+            raise HTTPException(status_code=502, detail="Failed to upload file")
+
+        await blobs_collection.update_one({"_id": key}, {"$set": {"url": url, "variants": variants}})
+        return url, variants
+
+    async def upload(self, file: UploadFile, folder_name: str) -> str:
+        size = self._check_size(file)
+        digest = await self._digest(file)
+        extension = os.path.splitext(file.filename or "")[1].lower()
+
+        async def store(uploaded: List[str]):
+            url = await self._run(crud.upload_blob, f"{folder_name}/{digest}{extension}", file.file,
+                                  file.content_type, size, size=size)
+            uploaded.append(url)
+            return url, {}
+
+        url, _ = await self._store(f"raw:{digest}", folder_name, store)
+        return url
+
+    async def upload_image(self, file: UploadFile, folder_name: str) -> Tuple[str, Dict[str, str]]:
+        # Returns the URL to store in the existing image field (the "full" variant)
+        # and the URL of every variant by name
+        if not image_processor.available:
+            return await self.upload(file, folder_name), {}
+
+        self._check_size(file)
+        digest = await self._digest(file)
+        extension = IMAGE_FORMAT.lower()
+
+        async def store(uploaded: List[str]):
+            renditions = await image_processor.normalize(await file.read())
+            names = list(renditions)
+            results = await asyncio.gather(*(
+                self._run(crud.upload_blob, f"{folder_name}/{digest}-{name}.{extension}",
+                          io.BytesIO(renditions[name]), IMAGE_CONTENT_TYPE, len(renditions[name]),
+                          size=len(renditions[name]))
+                for name in names
+            ), return_exceptions=True)
+
+            uploaded.extend(result for result in results if not isinstance(result, BaseException))
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            variants = dict(zip(names, results))
+            return variants["full"], variants
+
+        return await self._store(f"image:{digest}", folder_name, store)
+
+    async def _drop_reference(self, key: str, uploaded: Optional[List[str]] = None):
+        blob = await blobs_collection.find_one_and_update(
+            {"_id": key}, {"$inc": {"refs": -1}}, return_document=ReturnDocument.AFTER
+        )
+        if blob is None or blob["refs"] > 0:
+            return
+        # Only the request that removes the record queues the objects; a concurrent
+        # upload of the same content will have bumped refs and kept it alive
+        if await blobs_collection.find_one_and_delete({"_id": key, "refs": {"$lte": 0}}):
+            if blob.get("url"):
+                await schedule_deletion([blob["url"], *blob.get("variants", {}).values()], key)
+            elif uploaded:
+                await schedule_deletion(uploaded, key)
+
+    async def _blocking(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def sign_upload(self, purpose: str, content_type: str) -> dict:
+        # The client PUTs the bytes straight to the bucket, then passes object_name to
+        # the endpoint that uses the image, which finalizes it
+        folder_name = UPLOAD_FOLDERS.get(purpose)
+        if folder_name is None:
+            raise HTTPException(status_code=400, detail=f"Unknown upload purpose: {purpose}")
+        if content_type not in SIGNED_UPLOAD_CONTENT_TYPES:
+            raise HTTPException(status_code=400, detail="Unsupported image type")
+
+        object_name = f"{folder_name}/{uuid.uuid4()}"
+        expires_at = datetime.utcnow() + SIGNED_UPLOAD_TTL
+        headers = {
+            "Content-Type": content_type,
+            "Cache-Control": crud.BLOB_CACHE_CONTROL,
+            "x-goog-content-length-range": f"0,{self.max_bytes}",
+        }
+        upload_url = await self._blocking(crud.signed_upload_url, object_name, headers, SIGNED_UPLOAD_TTL)
+
+        await signed_uploads_collection.insert_one({
+            "_id": object_name,
+            "folder": folder_name,
+            "content_type": content_type,
+            "expires_at": expires_at,
+        })
+        # If it is never finalized the sweeper removes the object once the URL is dead
+        await schedule_deletion([crud.blob_public_url(object_name)], delay=SIGNED_UPLOAD_TTL + BLOB_GC_GRACE)
+        return {"upload_url": upload_url, "object_name": object_name, "headers": headers, "expires_at": expires_at}
+
+    async def finalize(self, object_name: str, folder_name: str) -> str:
+        # Checks a signed upload landed and is what was signed for, then makes it a
+        # regular reference-counted upload
+        pending = await signed_uploads_collection.find_one({"_id": object_name, "folder": folder_name})
+        if pending is None:
+            raise HTTPException(status_code=400, detail="Unknown or expired upload")
+
+        blob = await self._blocking(crud.get_uploaded_blob, object_name)
+        if blob is None:
+            raise HTTPException(status_code=400, detail="Upload not found, PUT the file first")
+        if blob.size > self.max_bytes:
+            self.metrics.rejected += 1
+            raise HTTPException(status_code=413,
+                                detail=f"File too large, the limit is {self.max_bytes // (1024 * 1024)}MB")
+        if blob.content_type != pending["content_type"]:
+            raise HTTPException(status_code=400, detail="Uploaded content type does not match")
+
+        # Single use, so two requests can't both attach the same object
+        if not (await signed_uploads_collection.delete_one({"_id": object_name})).deleted_count:
+            raise HTTPException(status_code=400, detail="Upload already used")
+
+        url = blob.public_url
+        await blobs_collection.insert_one({
+            "_id": f"upload:{object_name}", "url": url, "variants": {}, "refs": 1, "created_at": datetime.utcnow()
+        })
+        return url
+
+    async def receive_image(self, file: Optional[UploadFile], object_name: Optional[str],
+                            folder_name: str) -> Tuple[str, Dict[str, str]]:
+        # An image is either sent with the request or uploaded beforehand with a signed URL
+        if object_name:
+            return await self.finalize(object_name, folder_name), {}
+        if file is not None:
+            return await self.upload_image(file, folder_name)
+        return "", {}
+
+    def discard(self, upload: asyncio.Task):
+        # For an upload started alongside validation that then failed: let it finish in
+        # the background and release whatever it stored, so the error returns right away
+        task = asyncio.create_task(self._discard(upload))
+        self._discarding.add(task)
+        task.add_done_callback(self._discarding.discard)
+
+    async def _discard(self, upload: asyncio.Task):
+        try:
+            url, _ = await upload
+        except (Exception, asyncio.CancelledError):
+            # A failed upload has already cleaned up after itself
+            return
+        if url:
+            await self.release(url)
+
+    async def release(self, url: str):
+        # Called when a record stops pointing at an uploaded file. Nothing is deleted
+        # here; unreferenced objects are queued for blob_gc.blob_sweeper.
+        blob = await blobs_collection.find_one({"url": url}, {"_id": 1})
+        if blob is None:
+            # Uploaded before content addressing, so nothing else shares it
+            await schedule_deletion([url])
+            return
+        await self._drop_reference(blob["_id"])
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+upload_service = UploadService(UPLOAD_WORKERS, UPLOAD_MAX_BYTES)